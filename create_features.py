@@ -1,5 +1,8 @@
 import os
+import re
 from sqlalchemy import create_engine, text
+from utils._matview import create_global_stats
+from utils._setores import SIMPLIFY_LODS
 
 # Conexão ao banco (usa DATABASE_URL do compose; fallback para serviço db)
 db_url = os.getenv("DATABASE_URL", "postgresql://myuser:mypassword@db:5432/geodb")
@@ -9,6 +12,12 @@ setores_table = os.getenv("SETORES_TABLE", "sp_setores")
 pois_table = os.getenv("POIS_TABLE", "pois_metro_sp")
 dist_col = os.getenv("DIST_COL", "distancia_metro_m")
 crs_metric = int(os.getenv("CRS_METRIC", "31983"))  # SIRGAS 2000 / UTM 23S
+# Raio (m) que limita os candidatos do KNN; setores sem estação no raio caem numa 2ª passada sem limite
+knn_max_dist = float(os.getenv("KNN_MAX_DIST_M", "50000"))
+
+# Slug de linha para nome de coluna: remove acentos e mantém apenas [A-Z0-9_]
+_SLUG_TRANS = str.maketrans('ÇÃÁÉÍÓÚÂÊÔçãáéíóúâêô', 'CAAEIOUAEOCAAEIOUAEO')
+_SLUG_RE = re.compile(r'[^A-Z0-9_]+')
 
 engine = create_engine(db_url, pool_pre_ping=True)
 
@@ -18,6 +27,54 @@ with engine.begin() as conn:
     conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_{setores_table}_geom ON {setores_table} USING GIST (geom);"))
     conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_{pois_table}_geom ON {pois_table} USING GIST (geom);"))
 
+    # Caixa envolvente persistida (coluna gerada) para os filtros por bbox da API:
+    # o `&&` compara geometrias pequenas e fixas sem destoastar o polígono completo
+    for tbl in (setores_table, pois_table):
+        conn.execute(text(
+            f"ALTER TABLE {tbl} ADD COLUMN IF NOT EXISTS geom_bbox geometry(Geometry,4326) "
+            f"GENERATED ALWAYS AS (ST_Envelope(geom)) STORED;"
+        ))
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_{tbl}_geom_bbox ON {tbl} USING GIST (geom_bbox);"))
+    print(f"Column 'geom_bbox' ensured on '{setores_table}' and '{pois_table}'.")
+
+    # Geometrias simplificadas pré-calculadas (níveis de detalhe) para o /heatmap?simplify=...
+    # ST_Simplify com preserveCollapsed mantém polígonos pequenos em vez de devolver NULL
+    for lod_col, tol in SIMPLIFY_LODS.items():
+        conn.execute(text(
+            f"ALTER TABLE {setores_table} ADD COLUMN IF NOT EXISTS {lod_col} geometry(Geometry,4326) "
+            f"GENERATED ALWAYS AS (ST_Simplify(geom, {tol}, true)) STORED;"
+        ))
+    print(f"Simplified geometry columns {', '.join(SIMPLIFY_LODS)} ensured on '{setores_table}'.")
+
+    # Geometria em Web Mercator para os vector tiles (/tiles/{z}/{x}/{y}.mvt), sem ST_Transform por tile
+    conn.execute(text(
+        f"ALTER TABLE {setores_table} ADD COLUMN IF NOT EXISTS geom_3857 geometry(Geometry,3857) "
+        f"GENERATED ALWAYS AS (ST_Transform(geom, 3857)) STORED;"
+    ))
+    conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_{setores_table}_geom_3857 ON {setores_table} USING GIST (geom_3857);"))
+    print(f"Column 'geom_3857' ensured on '{setores_table}'.")
+
+    # Ponto representativo (dentro do polígono) para o /points, calculado uma única vez
+    conn.execute(text(
+        f"ALTER TABLE {setores_table} ADD COLUMN IF NOT EXISTS geom_pt geometry(Point,4326) "
+        f"GENERATED ALWAYS AS (ST_PointOnSurface(geom)) STORED;"
+    ))
+    conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_{setores_table}_geom_pt ON {setores_table} USING GIST (geom_pt);"))
+    print(f"Column 'geom_pt' ensured on '{setores_table}'.")
+
+    # Geometria já projetada no CRS métrico (calculada uma única vez), para que o
+    # KNN (<->) e o ST_Distance operem em metros sem ST_Transform por linha
+    for tbl, geom_type in ((setores_table, "Geometry"), (pois_table, "Point")):
+        conn.execute(text(
+            f"ALTER TABLE {tbl} ADD COLUMN IF NOT EXISTS geom_m geometry({geom_type},{crs_metric});"
+        ))
+        conn.execute(text(
+            f"UPDATE {tbl} SET geom_m = ST_Transform(geom, {crs_metric}) WHERE geom_m IS NULL AND geom IS NOT NULL;"
+        ))
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_{tbl}_geom_m ON {tbl} USING GIST (geom_m);"))
+        conn.execute(text(f"ANALYZE {tbl};"))
+    print(f"Column 'geom_m' (SRID {crs_metric}) ensured on '{setores_table}' and '{pois_table}'.")
+
     # Adicionar coluna de distância, se não existir
     conn.execute(text(
         f"ALTER TABLE {setores_table} ADD COLUMN IF NOT EXISTS {dist_col} DOUBLE PRECISION;"
@@ -29,42 +86,89 @@ with engine.begin() as conn:
     update_query = f"""
         UPDATE {setores_table} s
         SET {dist_col} = (
-            SELECT ST_Distance(
-                ST_Transform(s.geom, {crs_metric}),
-                ST_Transform(p.geom, {crs_metric})
-            )
+            SELECT ST_Distance(s.geom_m, p.geom_m)
             FROM {pois_table} p
-            ORDER BY s.geom <-> p.geom
+            WHERE ST_DWithin(p.geom_m, s.geom_m, :max_dist)
+            ORDER BY p.geom_m <-> s.geom_m
             LIMIT 1
         )
-        WHERE s.geom IS NOT NULL;
+        WHERE s.geom_m IS NOT NULL;
     """
-    conn.execute(text(update_query))
+    conn.execute(text(update_query), {"max_dist": knn_max_dist})
+    # Fallback sem limite para setores sem estação dentro do raio
+    fallback_query = f"""
+        UPDATE {setores_table} s
+        SET {dist_col} = (
+            SELECT ST_Distance(s.geom_m, p.geom_m)
+            FROM {pois_table} p
+            ORDER BY p.geom_m <-> s.geom_m
+            LIMIT 1
+        )
+        WHERE s.geom_m IS NOT NULL AND s.{dist_col} IS NULL;
+    """
+    conn.execute(text(fallback_query))
 
     # Distâncias por linha (cria colunas distancia_metro_<linha>)
     print("Computing distances per metro line...")
     linhas = [r[0] for r in conn.execute(text(f"SELECT DISTINCT emt_linha FROM {pois_table} WHERE emt_linha IS NOT NULL"))]
+    cols = {}  # coluna -> linha
     for linha in linhas:
         # slug seguro para nome de coluna
-        slug = linha.strip().upper().replace('Ç','C').replace('Ã','A').replace('Á','A').replace('É','E').replace('Í','I').replace('Ó','O').replace('Ú','U').replace('Â','A').replace('Ê','E').replace('Ô','O')
-        slug = ''.join(ch for ch in slug if ch.isalnum() or ch=='_')
-        col = f"distancia_metro_{slug}"
-        conn.execute(text(f"ALTER TABLE {setores_table} ADD COLUMN IF NOT EXISTS {col} DOUBLE PRECISION;"))
+        slug = _SLUG_RE.sub('', linha.strip().upper().translate(_SLUG_TRANS))
+        cols[f"distancia_metro_{slug}"] = linha
+
+    if cols:
+        # Um único ALTER TABLE (um ciclo de lock ACCESS EXCLUSIVE) para todas as colunas
+        add_sql = ", ".join(f"ADD COLUMN IF NOT EXISTS {col} DOUBLE PRECISION" for col in cols)
+        conn.execute(text(f"ALTER TABLE {setores_table} {add_sql};"))
+
+        # KNN por (setor, linha) via LATERAL e pivot com FILTER, num único UPDATE por passada
+        params = {f"linha_{i}": linha for i, linha in enumerate(cols.values())}
+        pivot_sql = ",\n                   ".join(
+            f"MIN(d) FILTER (WHERE emt_linha = :linha_{i}) AS {col}" for i, col in enumerate(cols)
+        )
         q = f"""
-            UPDATE {setores_table} s
-            SET {col} = (
-                SELECT ST_Distance(
-                    ST_Transform(s.geom, {crs_metric}),
-                    ST_Transform(p.geom, {crs_metric})
-                )
-                FROM {pois_table} p
-                WHERE p.emt_linha = :linha
-                ORDER BY s.geom <-> p.geom
-                LIMIT 1
+            WITH linhas AS (
+                SELECT DISTINCT emt_linha FROM {pois_table} WHERE emt_linha IS NOT NULL
+            ), nearest_per_line AS (
+                SELECT s."CD_SETOR" AS id, l.emt_linha, p.d
+                FROM {setores_table} s
+                CROSS JOIN linhas l
+                LEFT JOIN LATERAL (
+                    SELECT ST_Distance(s.geom_m, p2.geom_m) AS d
+                    FROM {pois_table} p2
+                    WHERE p2.emt_linha = l.emt_linha{{bound_sql}}
+                    ORDER BY p2.geom_m <-> s.geom_m
+                    LIMIT 1
+                ) p ON true
+                WHERE s.geom_m IS NOT NULL{{pending_sql}}
+            ), pivot AS (
+                SELECT id,
+                   {pivot_sql}
+                FROM nearest_per_line
+                GROUP BY id
             )
-            WHERE s.geom IS NOT NULL;
+            UPDATE {setores_table} s
+            SET {{set_sql}}
+            FROM pivot n
+            WHERE s."CD_SETOR" = n.id;
         """
-        conn.execute(text(q), {"linha": linha})
-        print(f"Updated {col}")
+        # 1ª passada: candidatos limitados ao raio (ST_DWithin usa o índice GIST de geom_m)
+        conn.execute(text(q.format(
+            bound_sql="\n                      AND ST_DWithin(p2.geom_m, s.geom_m, :max_dist)",
+            pending_sql="",
+            set_sql=", ".join(f"{col} = n.{col}" for col in cols),
+        )), {**params, "max_dist": knn_max_dist})
+        # 2ª passada: sem limite, apenas setores com alguma linha sem estação no raio
+        conn.execute(text(q.format(
+            bound_sql="",
+            pending_sql=" AND (" + " OR ".join(f"s.{col} IS NULL" for col in cols) + ")",
+            set_sql=", ".join(f"{col} = COALESCE(s.{col}, n.{col})" for col in cols),
+        )), params)
+        print(f"Updated {', '.join(cols)}")
+
+    # Distâncias recalculadas: recria as estatísticas globais servidas pela API (com a
+    # definição atual da consulta de /stats)
+    create_global_stats(conn)
 
 print(f"Successfully updated '{dist_col}' with distances from metro stations.")
\ No newline at end of file
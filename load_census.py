@@ -1,8 +1,16 @@
 import os
+import asyncio
+import aiohttp
+import orjson
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
 from typing import List
+from urllib3.util.retry import Retry
 from sqlalchemy import create_engine, text
+from utils._copy import copy_df, copy_staging
+from utils._matview import refresh_global_stats
+from utils._setores import ensure_cd_mun_index
 
 # Configuração do banco via variável de ambiente (alinhado ao docker-compose)
 db_url = os.getenv("DATABASE_URL", "postgresql://myuser:mypassword@db:5432/geodb")
@@ -29,28 +37,60 @@ def _build_url(localidades_param: str) -> str:
     p = f"?localidades={localidades_param}"
     if classificacao:
         p += f"&classificacao={classificacao}"
-    return base_url + p
+    # view=flat: lista plana de linhas (1ª linha = cabeçalho), direto para DataFrame
+    return base_url + p + "&view=flat"
 
 engine = create_engine(db_url, pool_pre_ping=True)
 print("Database engine created successfully.")
 
+def _table_columns(conn) -> dict:
+    """Colunas da tabela-alvo numa única consulta ao catálogo: {nome_minúsculo: nome_original}."""
+    rows = conn.execute(text(
+        """
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema = 'public' AND table_name = :tbl
+        """
+    ), {"tbl": table_name.lower()}).fetchall()
+    return {r[0].lower(): r[0] for r in rows}
+
+# Sessão compartilhada para a busca única (não loteada)
+session = requests.Session()
+session.mount("https://", HTTPAdapter(max_retries=Retry(total=3, backoff_factor=0.5)))
+
+async def _fetch_chunks_async(urls: List[str], max_in_flight: int) -> list:
+    """Dispara todos os lotes com no máximo max_in_flight requisições simultâneas (1 thread)."""
+    # O semáforo limita os lotes em voo: o timeout total só corre depois que o lote é
+    # liberado, sem contar a espera por uma conexão livre no pool
+    timeout = aiohttp.ClientTimeout(total=90)
+    connector = aiohttp.TCPConnector(limit=max_in_flight)
+    sem = asyncio.Semaphore(max_in_flight)
+
+    async def fetch(client: aiohttp.ClientSession, idx: int, url: str):
+        async with sem:
+            print(f"Fetching IBGE Agregados from: {url}")
+            try:
+                async with client.get(url) as r:
+                    r.raise_for_status()
+                    return orjson.loads(await r.read())
+            except Exception as e:
+                print(f"Falha no fetch do lote {idx+1}: {e}")
+                return None
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as client:
+        return await asyncio.gather(*(fetch(client, i, u) for i, u in enumerate(urls)))
+
 def _fetch_chunked(loc_codes: List[str]) -> list:
-    """Busca em lotes (comma-separated) para evitar URLs muito longas."""
+    """Busca em lotes (comma-separated) para evitar URLs muito longas, com lotes concorrentes."""
     data_all = []
     chunk_size = int(os.getenv("IBGE_CHUNK_SIZE", "100"))
-    for i in range(0, len(loc_codes), chunk_size):
-        sub = loc_codes[i:i+chunk_size]
-        loc_param = f"N6[{','.join(sub)}]"
-        url = _build_url(loc_param)
-        print(f"Fetching IBGE Agregados from: {url}")
-        try:
-            r = requests.get(url, timeout=90)
-            r.raise_for_status()
-            d = r.json()
-            if isinstance(d, list):
-                data_all.extend(d)
-        except Exception as e:
-            print(f"Falha no fetch do lote {i//chunk_size+1}: {e}")
+    max_in_flight = int(os.getenv("IBGE_MAX_WORKERS", "8"))
+    urls = [
+        _build_url(f"N6[{','.join(loc_codes[i:i+chunk_size])}]")
+        for i in range(0, len(loc_codes), chunk_size)
+    ]
+    for d in asyncio.run(_fetch_chunks_async(urls, max_in_flight)):
+        if isinstance(d, list):
+            data_all.extend(d[1:])  # descarta o cabeçalho de cada lote
     return data_all
 
 # Determina estratégia de busca
@@ -69,37 +109,36 @@ else:
     api_url = _build_url(localidades)
     print(f"Fetching IBGE Agregados from: {api_url}")
     try:
-        response = requests.get(api_url, timeout=60)
+        response = session.get(api_url, timeout=60)
         response.raise_for_status()
-        data = response.json()
+        data = orjson.loads(response.content)
+        data = data[1:] if isinstance(data, list) else data
     except Exception as e:
         print(f"Falha ao acessar API Agregados: {e}")
         raise SystemExit(1)
 
-# Parse do retorno v3 (agregados): resultados -> series -> localidade{id} / serie{periodo: valor}
+# Parse do retorno v3 (agregados, view=flat): uma linha por localidade/período com
+# colunas como localidade (ou D1C), valor (ou V) e período (D2C)
 df_renda = None
 try:
-    rows = []
-    if isinstance(data, list):
-        for bloco in data:
-            for res in bloco.get("resultados", []) if isinstance(bloco, dict) else []:
-                for serie in res.get("series", []):
-                    loc = serie.get("localidade", {}) or {}
-                    loc_id = str(loc.get("id")) if loc else None
-                    serie_dict = serie.get("serie", {}) or {}
-                    if not serie_dict:
-                        continue
-                    # tenta pegar o período solicitado, senão o último disponível
-                    valor = None
-                    if periodos and periodos != "last":
-                        valor = serie_dict.get(str(periodos))
-                    if valor is None:
-                        last_key = sorted(serie_dict.keys())[-1]
-                        valor = serie_dict.get(last_key)
-                    if loc_id is not None and valor is not None:
-                        rows.append({"cd_setor": loc_id, "vl_renda": valor})
-    if rows:
-        df_renda = pd.DataFrame(rows)
+    if isinstance(data, list) and data:
+        df_flat = pd.DataFrame(data)
+        df_flat.columns = [str(c).lower() for c in df_flat.columns]
+        k_loc = next((k for k in ("localidade", "d1c", "n6", "id_localidade") if k in df_flat.columns), None)
+        k_val = next((k for k in ("valor", "v") if k in df_flat.columns), None)
+        k_per = next((k for k in ("periodo", "d2c") if k in df_flat.columns), None)
+        if not (k_loc and k_val):
+            raise ValueError(f"Colunas de localidade/valor não identificadas no flat: {list(df_flat.columns)}")
+        # por localidade: o período solicitado, se houver; senão o mais recente disponível
+        if k_per:
+            per = df_flat[k_per].astype(str)
+            pedido = per == str(periodos) if periodos and periodos != "last" else False
+            df_flat = (
+                df_flat.assign(_pedido=pedido, _per=per)
+                .sort_values(["_pedido", "_per"], kind="stable")
+                .drop_duplicates(k_loc, keep="last")
+            )
+        df_renda = df_flat.rename(columns={k_loc: "cd_setor", k_val: "vl_renda"})[["cd_setor", "vl_renda"]]
     if df_renda is None or df_renda.empty:
         raise ValueError("Resposta vazia ou sem séries válidas para os parâmetros informados.")
 except Exception as e:
@@ -123,26 +162,22 @@ if avg_len < 13:
 
     with engine.begin() as conn:
         # Adiciona a coluna se não existir
-        col_check = conn.execute(text(
-            """
-            SELECT 1 FROM information_schema.columns
-            WHERE table_schema = 'public' AND table_name = :tbl AND column_name = 'vl_renda'
-            """
-        ), {"tbl": table_name.lower()}).fetchone()
-        if not col_check:
+        if "vl_renda" not in _table_columns(conn).values():
             conn.execute(text(f"ALTER TABLE {table_name} ADD COLUMN vl_renda NUMERIC"))
             print("Database table altered: added vl_renda column.")
 
         applied = False
         if id_len == 7:
             # Mapeia por município (N6)
-            tmp = df_renda.rename(columns={"cd_setor": "cd_mun"}).copy()
-            tmp.to_sql('temp_renda_mun', con=conn, if_exists='replace', index=False)
+            tmp = df_renda.rename(columns={"cd_setor": "cd_mun"}).drop_duplicates("cd_mun", keep="last")
+            # Mesmo join de load_census_sector_income.py: "CD_MUN" sem cast, índice simples na coluna
+            copy_staging(conn, tmp, 'temp_renda_mun', "cd_mun text PRIMARY KEY, vl_renda numeric")
+            ensure_cd_mun_index(conn, table_name)
             update_sql = text(f"""
                 UPDATE {table_name} tgt
                 SET vl_renda = src.vl_renda
                 FROM temp_renda_mun src
-                WHERE tgt."CD_MUN"::text = src.cd_mun::text
+                WHERE tgt."CD_MUN" = src.cd_mun
             """)
             conn.execute(update_sql)
             conn.execute(text('DROP TABLE IF EXISTS temp_renda_mun'))
@@ -150,26 +185,29 @@ if avg_len < 13:
             applied = True
         elif id_len == 2:
             # Mapeia por UF (N3)
-            tmp = df_renda.rename(columns={"cd_setor": "cd_uf"}).copy()
-            tmp.to_sql('temp_renda_uf', con=conn, if_exists='replace', index=False)
+            tmp = df_renda.rename(columns={"cd_setor": "cd_uf"}).drop_duplicates("cd_uf", keep="last")
+            copy_staging(conn, tmp, 'temp_renda_uf', "cd_uf text PRIMARY KEY, vl_renda numeric")
             update_sql = text(f"""
                 UPDATE {table_name} tgt
                 SET vl_renda = src.vl_renda
                 FROM temp_renda_uf src
-                WHERE tgt."CD_UF"::text = src.cd_uf::text
+                WHERE tgt."CD_UF"::text = src.cd_uf
             """)
             conn.execute(update_sql)
             conn.execute(text('DROP TABLE IF EXISTS temp_renda_uf'))
             print("vl_renda atualizada por UF (CD_UF).")
             applied = True
 
+        if applied:
+            refresh_global_stats(conn)
+
     # Sempre salvar staging para referência
     staging_table = os.getenv("AGREGADO_STAGING_TABLE", "ibge_agregado_result")
     try:
         with engine.begin() as conn:
             df_to_save = df_renda.copy()
             df_to_save.rename(columns={"cd_setor": "id_localidade", "vl_renda": "valor"}, inplace=True)
-            df_to_save.to_sql(staging_table, con=conn, if_exists='replace', index=False)
+            copy_df(conn, df_to_save, staging_table)
         print(f"Dados agregados salvos em staging '{staging_table}'.")
     except Exception as e:
         print(f"Falha ao salvar staging '{staging_table}': {e}")
@@ -179,20 +217,21 @@ if avg_len < 13:
     raise SystemExit(0)
 
 with engine.begin() as conn:
+    # Colunas da tabela-alvo (uma consulta ao catálogo, reusada abaixo)
+    name_map = _table_columns(conn)  # lower -> original
+
     # Adiciona a coluna se não existir
-    col_check = conn.execute(text(
-        """
-        SELECT 1 FROM information_schema.columns
-        WHERE table_schema = 'public' AND table_name = :tbl AND column_name = 'vl_renda'
-        """
-    ), {"tbl": table_name.lower()}).fetchone()
-    if not col_check:
+    if "vl_renda" not in name_map.values():
         conn.execute(text(f"ALTER TABLE {table_name} ADD COLUMN vl_renda NUMERIC"))
         print("Database table altered: added vl_renda column.")
 
-    # Sobe os dados temporariamente
-    # Use a conexão SQLAlchemy direta
-    df_renda.to_sql('temp_renda', con=conn, if_exists='replace', index=False)
+    # Sobe os dados temporariamente (UNLOGGED + PK; COPY na mesma transação)
+    copy_staging(
+        conn,
+        df_renda.drop_duplicates("cd_setor", keep="last"),
+        'temp_renda',
+        "cd_setor text PRIMARY KEY, vl_renda numeric",
+    )
 
     # Descobre coluna de join existente na tabela-alvo (case-insensitive)
     preferred_order = [
@@ -202,13 +241,6 @@ with engine.begin() as conn:
         "cd_setor_censitario",
         "cd_censitario",
     ]
-    rows = conn.execute(text(
-        """
-        SELECT column_name FROM information_schema.columns
-        WHERE table_schema = 'public' AND table_name = :tbl
-        """
-    ), {"tbl": table_name.lower()}).fetchall()
-    name_map = {r[0].lower(): r[0] for r in rows}  # lower -> original
     join_col_key = next((c for c in preferred_order if c in name_map), None)
     if not join_col_key:
         raise SystemExit(
@@ -217,14 +249,20 @@ with engine.begin() as conn:
     join_col = name_map[join_col_key]  # preserva o case original
     print(f"Using join column: {join_col}")
 
+    # Índice funcional casando com o cast do join (idempotente)
+    conn.execute(text(
+        f'CREATE INDEX IF NOT EXISTS idx_{table_name}_{join_col.lower()}_text ON {table_name} (("{join_col}"::text))'
+    ))
+
     # Cita o identificador para evitar problemas de case (ex.: "CD_SETOR")
     update_query = text(f"""
         UPDATE {table_name} tgt
         SET vl_renda = src.vl_renda
         FROM temp_renda src
-        WHERE tgt."{join_col}"::text = src.cd_setor::text
+        WHERE tgt."{join_col}"::text = src.cd_setor
     """)
     conn.execute(update_query)
     conn.execute(text('DROP TABLE IF EXISTS temp_renda'))
+    refresh_global_stats(conn)
 
 print("Successfully updated the PostGIS table with income data.")
\ No newline at end of file
@@ -27,12 +27,14 @@ Observação:
 
 import os
 import re
-import math
 import json
+import numpy as np
 import pandas as pd
 import requests
 from typing import Dict, List, Optional, Tuple
 from sqlalchemy import create_engine, text
+from utils._copy import copy_staging
+from utils._setores import ensure_cd_mun_index
 
 
 # -------------------- Config --------------------
@@ -49,11 +51,22 @@ DEFAULT_SM = {
     "2025": 1512.0,
 }
 
+# Padrões de rótulos de classe (compilados uma vez; ver parse_bounds_from_label)
+_FRAC = r"([0-9]+(?:\/[0-9]+)?)"
+_NUM = r"([0-9]+(?:[\.,][0-9]+)?)"
+_RE_ANO = re.compile(r"(20\d{2})")
+_RE_ATE_SM = re.compile(rf"até\s*{_FRAC}.*(sm|sal[aá]rio)")
+_RE_MAIS_A_SM = re.compile(rf"mais de\s*{_FRAC}.*a\s*{_FRAC}.*(sm|sal[aá]rio)")
+_RE_MAIS_SM = re.compile(rf"mais de\s*{_FRAC}.*(sm|sal[aá]rio)")
+_RE_ATE_RS = re.compile(rf"at[eé]\s*{_NUM}")
+_RE_MAIS_A_RS = re.compile(rf"mais de\s*{_NUM}\s*a\s*{_NUM}")
+_RE_MAIS_RS = re.compile(rf"mais de\s*{_NUM}$")
+
 
 def salario_minimo_para_periodo(periodos: str) -> float:
     ano = None
     # tenta extrair ano AAAA
-    m = re.search(r"(20\d{2})", str(periodos))
+    m = _RE_ANO.search(str(periodos))
     if m:
         ano = m.group(1)
     return float(os.getenv(f"SALARIO_MIN_{ano}", DEFAULT_SM.get(ano or "2022", 1212.0)))
@@ -78,40 +91,26 @@ def parse_bounds_from_label(label: str, sm: float) -> Tuple[Optional[float], Opt
     if "salário" in s or "salario" in s or "sm" in s:
         # extrair frações tipo 1/2, 1, 2 etc.
         # padrões: "até X sm", "mais de A a B sm", "mais de X sm"
-        frac_pattern = r"([0-9]+(?:\/[0-9]+)?)"
         # Até X SM
-        m = re.search(rf"até\s*{frac_pattern}.*(sm|sal[aá]rio)", s)
-        if m:
-            x = m.group(1)
-            val = eval_fraction(x) * sm
-            return 0.0, val
+        if m := _RE_ATE_SM.search(s):
+            return 0.0, eval_fraction(m.group(1)) * sm
         # Mais de A a B SM
-        m = re.search(rf"mais de\s*{frac_pattern}.*a\s*{frac_pattern}.*(sm|sal[aá]rio)", s)
-        if m:
-            a, b = m.group(1), m.group(2)
-            return eval_fraction(a) * sm, eval_fraction(b) * sm
+        if m := _RE_MAIS_A_SM.search(s):
+            return eval_fraction(m.group(1)) * sm, eval_fraction(m.group(2)) * sm
         # Mais de X SM (aberta superior)
-        m = re.search(rf"mais de\s*{frac_pattern}.*(sm|sal[aá]rio)", s)
-        if m:
-            a = m.group(1)
-            return eval_fraction(a) * sm, None
+        if m := _RE_MAIS_SM.search(s):
+            return eval_fraction(m.group(1)) * sm, None
 
     # valores em R$
     # Até 105
-    m = re.search(r"at[eé]\s*([0-9]+(?:[\.,][0-9]+)?)", s)
-    if m:
-        v = to_float(m.group(1))
-        return 0.0, v
+    if m := _RE_ATE_RS.search(s):
+        return 0.0, to_float(m.group(1))
     # Mais de 105 a 210
-    m = re.search(r"mais de\s*([0-9]+(?:[\.,][0-9]+)?)\s*a\s*([0-9]+(?:[\.,][0-9]+)?)", s)
-    if m:
-        a, b = to_float(m.group(1)), to_float(m.group(2))
-        return a, b
+    if m := _RE_MAIS_A_RS.search(s):
+        return to_float(m.group(1)), to_float(m.group(2))
     # Mais de 2100 (aberta superior)
-    m = re.search(r"mais de\s*([0-9]+(?:[\.,][0-9]+)?)$", s)
-    if m:
-        a = to_float(m.group(1))
-        return a, None
+    if m := _RE_MAIS_RS.search(s):
+        return to_float(m.group(1)), None
 
     return None, None
 
@@ -127,38 +126,49 @@ def to_float(txt: str) -> float:
     return float(str(txt).replace(".", "").replace(",", "."))
 
 
-def synthetic_median_from_classes(classes: List[Tuple[float, Optional[float], float]]) -> float:
+def synthetic_median_by_mun(df: pd.DataFrame, sm: float) -> pd.DataFrame:
     """
-    Calcula a mediana por interpolação linear a partir de classes:
-    classes: lista de tuplas (min, max, freq) com min/max em R$ e freq em contagem ou percentual.
-    Retorna a mediana em R$.
+    Calcula a mediana por interpolação linear a partir de classes, para todos os municípios
+    de uma vez. df: colunas cd_mun, categoria, valor (freq em contagem ou percentual).
+    Os limites de cada rótulo são extraídos uma única vez por rótulo distinto.
+    Retorna df[cd_mun, vl_renda_setor] com a mediana em R$.
     """
-    # ordenar por limite inferior
-    classes = sorted(classes, key=lambda x: (x[0] if x[0] is not None else -math.inf))
-    total = sum(c[2] for c in classes if c[2] is not None)
-    if total <= 0:
-        return float("nan")
-    target = 0.5 * total
-    cum_prev = 0.0
-    for (a, b, f) in classes:
-        if f is None or f == 0:
-            continue
-        next_cum = cum_prev + f
-        if next_cum >= target:
-            # encontrou classe mediana
-            L = a if a is not None else 0.0
-            # largura da classe
-            if b is None or b <= L:
-                # última aberta ou intervalo inválido: retorna L
-                return float(L)
-            w = b - L
-            # posição dentro da classe
-            inside = (target - cum_prev) / f
-            return float(L + inside * w)
-        cum_prev = next_cum
-    # fallback: retorna último limite inferior
-    last = classes[-1][0]
-    return float(last if last is not None else 0.0)
+    cat = df["categoria"].astype(str)
+    bounds = {lab: parse_bounds_from_label(lab, sm) for lab in cat.unique()}
+    d = pd.DataFrame({
+        "cd_mun": df["cd_mun"].values,
+        "a": cat.map({lab: ab[0] for lab, ab in bounds.items()}).astype(float).values,
+        "b": cat.map({lab: ab[1] for lab, ab in bounds.items()}).astype(float).values,
+        "f": df["valor"].astype(float).values,
+    })
+    # descarta rótulos não reconhecidos; limite inferior ausente vale 0
+    d = d[d["a"].notna() | d["b"].notna()].copy()
+    if d.empty:
+        return pd.DataFrame(columns=["cd_mun", "vl_renda_setor"])
+    d["a"] = d["a"].fillna(0.0)
+    # ordenar por município e limite inferior (estável, como sorted)
+    d.sort_values(["cd_mun", "a"], kind="mergesort", inplace=True)
+
+    d["cum"] = d.groupby("cd_mun", sort=False)["f"].cumsum()
+    by_mun = d.groupby("cd_mun", sort=False)
+    d["cum_prev"] = by_mun["cum"].shift(fill_value=0.0)
+    total = by_mun["cum"].last()
+    d["target"] = 0.5 * d["cd_mun"].map(total)
+
+    # classe mediana: primeira classe com freq > 0 cuja frequência acumulada atinge a metade
+    hit = d[(d["f"] != 0) & (d["cum"] >= d["target"])].groupby("cd_mun", sort=False).head(1)
+    L = hit["a"].to_numpy()
+    b = hit["b"].to_numpy()
+    # última aberta ou intervalo inválido: retorna L
+    open_or_invalid = np.isnan(b) | (b <= L)
+    inside = (hit["target"].to_numpy() - hit["cum_prev"].to_numpy()) / hit["f"].to_numpy()
+    med_hit = np.where(open_or_invalid, L, L + inside * np.where(open_or_invalid, 0.0, b - L))
+
+    # fallback: último limite inferior; total <= 0 não tem mediana
+    med = by_mun["a"].last()
+    med.loc[hit["cd_mun"].to_numpy()] = med_hit
+    med[total <= 0] = np.nan
+    return med.rename("vl_renda_setor").rename_axis("cd_mun").reset_index()
 
 
 def compute_median_from_csv(csv_path: str, sm: float) -> pd.DataFrame:
@@ -175,20 +185,7 @@ def compute_median_from_csv(csv_path: str, sm: float) -> pd.DataFrame:
     df["cd_mun"] = df["cd_mun"].astype(str)
     df["valor"] = pd.to_numeric(df["valor"], errors="coerce").fillna(0.0)
 
-    # agrupa por município
-    rows = []
-    for cd_mun, g in df.groupby("cd_mun"):
-        classes = []
-        for _, r in g.iterrows():
-            a, b = parse_bounds_from_label(str(r["categoria"]), sm)
-            if a is None and b is None:
-                continue
-            classes.append((a or 0.0, b, float(r["valor"])) )
-        if not classes:
-            continue
-        med = synthetic_median_from_classes(classes)
-        rows.append({"cd_mun": cd_mun, "vl_renda_setor": med})
-    return pd.DataFrame(rows)
+    return synthetic_median_by_mun(df, sm)
 
 
 def upsert_to_db(df_median: pd.DataFrame):
@@ -206,14 +203,18 @@ def upsert_to_db(df_median: pd.DataFrame):
             print("Database table altered: added vl_renda_setor column.")
 
         # subir dados temporários para join por município
+        # cd_mun normalizado para o mesmo formato de "CD_MUN" (7 dígitos), sem cast no join
         df_tmp = df_median.copy()
-        df_tmp.to_sql("temp_mediana_mun", con=conn, if_exists="replace", index=False)
+        df_tmp["cd_mun"] = df_tmp["cd_mun"].astype(str).str.zfill(7)
+        df_tmp = df_tmp.drop_duplicates("cd_mun", keep="last")
+        copy_staging(conn, df_tmp, "temp_mediana_mun", "cd_mun varchar(7) PRIMARY KEY, vl_renda_setor numeric")
+        ensure_cd_mun_index(conn, TABLE_NAME)
         # atualizar setores
         conn.execute(text(f"""
             UPDATE {TABLE_NAME} tgt
             SET vl_renda_setor = src.vl_renda_setor
             FROM temp_mediana_mun src
-            WHERE tgt."CD_MUN"::text = src.cd_mun::text
+            WHERE tgt."CD_MUN" = src.cd_mun
         """))
         conn.execute(text("DROP TABLE IF EXISTS temp_mediana_mun"))
     print("vl_renda_setor atualizada por município (CD_MUN).")
@@ -278,19 +279,7 @@ def maybe_fetch_from_ibge(sm: float) -> Optional[pd.DataFrame]:
     df["valor"] = pd.to_numeric(df["valor"], errors="coerce").fillna(0.0)
 
     # construir medianas
-    out = []
-    for cd_mun, g in df.groupby("cd_mun"):
-        classes = []
-        for _, r in g.iterrows():
-            a, b = parse_bounds_from_label(str(r["categoria"]), sm)
-            if a is None and b is None:
-                continue
-            classes.append((a or 0.0, b, float(r["valor"])) )
-        if not classes:
-            continue
-        med = synthetic_median_from_classes(classes)
-        out.append({"cd_mun": cd_mun, "vl_renda_setor": med})
-    return pd.DataFrame(out)
+    return synthetic_median_by_mun(df, sm)
 
 
 def main():
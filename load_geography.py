@@ -1,6 +1,8 @@
 import geopandas as gpd
+import pyproj
 from sqlalchemy import create_engine, text
-from geoalchemy2 import Geometry, WKTElement
+from utils._matview import drop_global_stats
+from utils._transformer import to_crs
 import os
 
 # Use a URL do banco do ambiente (docker-compose define DATABASE_URL para 'db'),
@@ -16,16 +18,16 @@ print(f"Database engine created successfully. URL: {db_url}")
 
 # ---- leitura e preparaçao de dados --------
 print("Loading shapefile...")
-gdf = gpd.read_file(shapefile_path)
+gdf = gpd.read_file(shapefile_path, engine="pyogrio", use_arrow=True)
 print(f"Shapefile loaded with {len(gdf)} features successfully.")
 #-------------------------------------------
 
-if gdf.crs is None or gdf.crs.to_string() != crs_target:
+# Compara CRS semanticamente (ex.: 'EPSG:4326' vs 'WGS 84') para não reprojetar à toa
+if gdf.crs is None or not gdf.crs.equals(pyproj.CRS.from_user_input(crs_target)):
     print(f"Reprojecting from {gdf.crs} to {crs_target}...")
-    gdf = gdf.to_crs(crs_target)
+    gdf = to_crs(gdf, crs_target)
     
-gdf.rename(columns={'geometry': geometry_column}, inplace=True)
-gdf[geometry_column] = gdf[geometry_column].apply(lambda x: WKTElement(x.wkt, srid=4326))
+gdf = gdf.rename_geometry(geometry_column)
 
 # --------- postgis --------
 # Garante que a extensão PostGIS está habilitada no banco de destino
@@ -36,14 +38,17 @@ with engine.begin() as conn:
     except Exception as e:
         # Não falhar se já estiver habilitado/sem permissões; apenas reportar
         print(f"Warning: could not ensure PostGIS extension: {e}")
+    # A materialized view de estatísticas depende da tabela que será substituída
+    drop_global_stats(conn)
 
 print(f"Saving data to PostGIS table '{table_name}'...")
-gdf.to_sql(
+# to_postgis envia WKB em lotes (sem serializar WKT por linha). O tipo da coluna é inferido
+# dos dados (POLYGON, MULTIPOLYGON ou GEOMETRY genérico se misturados); dtype é ignorado
+gdf.to_postgis(
     table_name,
     engine,
     if_exists='replace',
     index=False,
-    # Usa GEOMETRY genérico para evitar conflitos Polygon/MultiPolygon
-    dtype={geometry_column: Geometry(geometry_type='GEOMETRY', srid=4326)}
+    chunksize=10000,
 )
 print("Successfully saved data to PostGIS.")
\ No newline at end of file
@@ -1,7 +1,8 @@
 import os
 import geopandas as gpd
+import pyproj
 from sqlalchemy import create_engine
-from geoalchemy2 import Geometry, WKTElement
+from utils._transformer import to_crs
 
 engine = create_engine(os.getenv("DATABASE_URL", "postgresql+psycopg2://postgres:postgres@db:5432/geo"))
 
@@ -16,7 +17,7 @@ print("Database engine created successfully.")
 
 # ---- leitura e preparaçao de dados --------
 print("Loading shapefile...")
-gdf = gpd.read_file(shapefile_path)
+gdf = gpd.read_file(shapefile_path, engine="pyogrio", use_arrow=True)
 print(f"Shapefile loaded with {len(gdf)} features successfully.")
 #-------------------------------------------
 
@@ -25,21 +26,20 @@ if gdf.crs is None:
     print(f"Input CRS is None — setting source CRS to {crs_source_default} (override with POIS_SOURCE_CRS)")
     gdf.set_crs(crs_source_default, inplace=True)
 
-# Reprojetar para 4326 se necessário
-if str(gdf.crs) != crs_target:
+# Reprojetar para 4326 se necessário (comparação semântica; 'EPSG:4326' == 'WGS 84')
+if not gdf.crs.equals(pyproj.CRS.from_user_input(crs_target)):
     print(f"Reprojecting from {gdf.crs} to {crs_target}...")
-    gdf = gdf.to_crs(crs_target)
+    gdf = to_crs(gdf, crs_target)
 
-gdf.rename(columns={'geometry': geometry_column}, inplace=True)
-gdf[geometry_column] = gdf[geometry_column].apply(lambda x: WKTElement(x.wkt, srid=4326))
+gdf = gdf.rename_geometry(geometry_column)
 
 # --------- postgis --------
 print(f"Saving data to PostGIS table '{table_name}'...")
-gdf.to_sql(
+gdf.to_postgis(
     table_name,
     engine,
     if_exists='replace',
     index=False,
-    dtype={geometry_column: Geometry('POINT', srid=4326)}
+    chunksize=10000,
 )
 print("Successfully saved data to PostGIS.")
\ No newline at end of file
@@ -1,24 +1,135 @@
 # app/main.py
 from fastapi import FastAPI, Query, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import Response
-from sqlalchemy import create_engine, text
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
+from sqlalchemy import make_url, text
+from sqlalchemy.ext.asyncio import create_async_engine
+from cachetools import TTLCache
+from utils._matview import GLOBAL_STATS_DEFAULTS, GLOBAL_STATS_VIEW
+from utils._setores import SIMPLIFY_LODS
+from utils._stats import build_stats_sql
 from typing import Optional
-import geopandas as gpd
+import asyncio
+import json
+import math
 import os
+import time
+import numpy as np
 
 
 DATABASE_URL = os.getenv("DATABASE_URL", "postgresql://myuser:mypassword@db:5432/geodb")
 
+# orjson como serializador padrão das respostas JSON (floats e arrays numpy)
 app = FastAPI(
+    default_response_class=ORJSONResponse,
     title="API de Dados Geoespaciais de SP",
     description="Uma API para servir dados de renda e proximidade a metrôs por setor censitário."
 )
-engine = create_engine(DATABASE_URL, pool_pre_ping=True)
+# Engine assíncrono (asyncpg): as rotas não bloqueiam o event loop enquanto aguardam o banco
+engine = create_async_engine(
+    make_url(DATABASE_URL).set(drivername="postgresql+asyncpg"),
+    pool_size=10,
+    max_overflow=20,
+    pool_pre_ping=True,
+    pool_recycle=1800,
+)
 
 # Métricas base conhecidas; demais (distancia_metro_*) serão descobertas dinamicamente via information_schema
 ALLOWED_METRICS = ["distancia_metro_m", "vl_renda", "vl_renda_setor"]
 
+# Caches de respostas por parâmetros (TTL de 5 min): os dados só mudam quando o ETL roda.
+# /stats guarda também a amostra de pares, que fica fixa durante o TTL.
+_stats_cache = TTLCache(maxsize=1024, ttl=300)
+_metrics_cache = TTLCache(maxsize=1, ttl=300)
+
+# Largura do mundo em Web Mercator (EPSG:3857), em metros
+WEB_MERCATOR_SIZE = 40075016.68557849
+
+# Limites absolutos de lon/lat para (minx, miny, maxx, maxy)
+_BBOX_LIMITS = np.array([180.0, 90.0, 180.0, 90.0])
+
+# Geometrias simplificadas pré-calculadas por create_features.py (tolerância em graus -> coluna)
+LOD_BY_TOLERANCE = {tol: col for col, tol in SIMPLIFY_LODS.items()}
+
+
+def parse_bbox(bbox: str) -> dict:
+    """
+    Converte "minLon,minLat,maxLon,maxLat" nos parâmetros :minx/:miny/:maxx/:maxy de
+    bbox_filter_sql, validando as faixas de lon/lat numa única comparação vetorial.
+    """
+    try:
+        arr = np.array(bbox.split(','), dtype=np.float64)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Parâmetro bbox inválido: {e}")
+    if arr.size != 4:
+        raise HTTPException(status_code=400, detail="Parâmetro bbox inválido: bbox deve ter 4 números")
+    if not (np.abs(arr) <= _BBOX_LIMITS).all():
+        raise HTTPException(status_code=400, detail="Parâmetro bbox inválido: bbox inválido")
+    minx, miny, maxx, maxy = arr.tolist()
+    return {"minx": minx, "miny": miny, "maxx": maxx, "maxy": maxy}
+
+
+def bbox_filter_sql(exact: bool = False) -> str:
+    """
+    Filtro espacial por bbox. Por padrão usa `&&` sobre geom_bbox (caixa envolvente persistida
+    por create_features.py, com índice GiST; falsos positivos ficam fora da área visível).
+    exact=True usa ST_Intersects sobre a geometria completa.
+    """
+    envelope = "ST_MakeEnvelope(:minx, :miny, :maxx, :maxy, 4326)"
+    return f"ST_Intersects(geom, {envelope})" if exact else f"geom_bbox && {envelope}"
+
+
+def feature_sql(properties_sql: str, id_sql: Optional[str] = None) -> str:
+    """
+    Expressão json de uma Feature GeoJSON sobre o alias t (coluna geom), com coordenadas
+    de 6 casas decimais (~11 cm).
+    """
+    id_part = f" 'id', {id_sql}," if id_sql else ""
+    return f"""json_build_object(
+                'type', 'Feature',{id_part}
+                'properties', {properties_sql},
+                'geometry', ST_AsGeoJSON(t.geom, 6)::json
+            )"""
+
+
+def feature_collection_sql(rows_sql: str, properties_sql: str, id_sql: Optional[str] = None) -> str:
+    """
+    Envolve rows_sql (alias t, com coluna geom) numa consulta que devolve o FeatureCollection
+    GeoJSON já serializado pelo PostGIS.
+    """
+    return f"""
+        SELECT json_build_object(
+            'type', 'FeatureCollection',
+            'features', COALESCE(json_agg({feature_sql(properties_sql, id_sql)}), '[]'::json)
+        )::text AS fc
+        FROM ({rows_sql}) t
+    """
+
+
+def feature_rows_sql(rows_sql: str, properties_sql: str, id_sql: Optional[str] = None) -> str:
+    """
+    Como feature_collection_sql, mas devolve uma Feature serializada por linha, para
+    respostas transmitidas em streaming (sem agregar o FeatureCollection na memória).
+    """
+    return f"""
+        SELECT {feature_sql(properties_sql, id_sql)}::text AS feature
+        FROM ({rows_sql}) t
+    """
+
+def pearson_from_sums(n, sx, sy, sxy, sxx, syy) -> Optional[float]:
+    """
+    Correlação de Pearson a partir das somas (n, Σx, Σy, Σxy, Σx², Σy²), calculadas no
+    mesmo agregado das demais estatísticas. None se n < 2 ou variância nula (como corr()).
+    """
+    if not n or n < 2:
+        return None
+    den = (n * sxx - sx * sx) * (n * syy - sy * sy)
+    if den <= 0:
+        return None
+    return max(-1.0, min(1.0, (n * sxy - sx * sy) / math.sqrt(den)))
+
 # CORS para desenvolvimento (Live Server e localhost)
 origins = [
     "http://127.0.0.1:5500",
@@ -33,144 +144,288 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Compressão das respostas (GeoJSON com coordenadas de 6 casas comprime bem)
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
+# Colunas de sp_setores (whitelist de métricas), carregadas no startup: o schema só muda
+# em deploy/ETL. Uma métrica ausente força uma nova leitura (no máximo a cada
+# SCHEMA_RELOAD_INTERVAL s), cobrindo tabelas/colunas criadas pelo ETL depois do boot
+ALLOWED_COLUMNS: frozenset = frozenset()
+SCHEMA_RELOAD_INTERVAL = 30.0
+_schema_loaded_at = float("-inf")
+
+
+async def load_schema() -> frozenset:
+    global ALLOWED_COLUMNS, _schema_loaded_at
+    _schema_loaded_at = time.monotonic()
+    async with engine.connect() as conn:
+        rows = (await conn.execute(text(
+            """
+            SELECT column_name FROM information_schema.columns
+            WHERE table_schema='public' AND table_name='sp_setores'
+            """
+        ))).fetchall()
+    cols = frozenset(r[0] for r in rows)
+    if cols != ALLOWED_COLUMNS:
+        _metrics_cache.clear()
+    ALLOWED_COLUMNS = cols
+    return ALLOWED_COLUMNS
+
+
+async def has_columns(*cols: str) -> bool:
+    """True se todas as colunas existem em sp_setores, recarregando o schema numa ausência."""
+    if all(c in ALLOWED_COLUMNS for c in cols):
+        return True
+    if time.monotonic() - _schema_loaded_at >= SCHEMA_RELOAD_INTERVAL:
+        try:
+            await load_schema()
+        except Exception as e:
+            print(f"Aviso: não foi possível recarregar o schema de sp_setores: {e}")
+    return all(c in ALLOWED_COLUMNS for c in cols)
+
+
+# Linhas de metrô, suas extensões e as colunas de atributos (não geométricas) de
+# pois_metro_sp, carregadas no startup (estáticas entre cargas do ETL; recarregadas junto
+# com o schema em POST /admin/refresh-schema). Se ainda vazias (ETL rodou depois do boot),
+# são carregadas sob demanda, no máximo a cada SCHEMA_RELOAD_INTERVAL s
+LINES: list = []
+LINE_EXTENTS: dict = {}
+STATION_COLUMNS: list = []
+_lines_loaded_at = float("-inf")
+
+
+async def load_lines() -> list:
+    global LINES, LINE_EXTENTS, STATION_COLUMNS, _lines_loaded_at
+    _lines_loaded_at = time.monotonic()
+    async with engine.connect() as conn:
+        cols = (await conn.execute(text(
+            """
+            SELECT column_name FROM information_schema.columns
+            WHERE table_schema='public' AND table_name='pois_metro_sp'
+              AND udt_name NOT IN ('geometry', 'geography')
+            ORDER BY ordinal_position
+            """
+        ))).fetchall()
+        rows = (await conn.execute(text(
+            """
+            SELECT linha, ST_XMin(e) AS xmin, ST_YMin(e) AS ymin, ST_XMax(e) AS xmax, ST_YMax(e) AS ymax
+            FROM (
+                SELECT emt_linha AS linha, ST_Extent(geom) AS e
+                FROM pois_metro_sp
+                WHERE emt_linha IS NOT NULL
+                GROUP BY emt_linha
+            ) t
+            ORDER BY 1
+            """
+        ))).mappings().all()
+    extents = {
+        r["linha"]: {
+            "bbox": [r["xmin"], r["ymin"], r["xmax"], r["ymax"]],
+            "center": [(r["ymin"] + r["ymax"]) / 2.0, (r["xmin"] + r["xmax"]) / 2.0],
+        }
+        for r in rows
+        if r["xmin"] is not None
+    }
+    LINES = [r["linha"] for r in rows]
+    LINE_EXTENTS = extents
+    STATION_COLUMNS = [r[0] for r in cols]
+    return LINES
+
+
+async def ensure_lines() -> None:
+    if (LINES and STATION_COLUMNS) or time.monotonic() - _lines_loaded_at < SCHEMA_RELOAD_INTERVAL:
+        return
+    try:
+        await load_lines()
+    except Exception as e:
+        print(f"Aviso: não foi possível carregar as linhas de metrô: {e}")
+
+
+# Estatísticas globais de /stats (sem bbox, parâmetros padrão) lidas da materialized view
+# mantida pelo ETL (utils/_matview.py); a API só verifica se ela existe (enquanto ausente,
+# de novo no máximo a cada SCHEMA_RELOAD_INTERVAL s)
+GLOBAL_STATS_READY = False
+_global_stats_checked_at = float("-inf")
+
+
+async def check_global_stats() -> bool:
+    global GLOBAL_STATS_READY, _global_stats_checked_at
+    _global_stats_checked_at = time.monotonic()
+    async with engine.connect() as conn:
+        GLOBAL_STATS_READY = (await conn.execute(
+            text("SELECT to_regclass(:v)"), {"v": GLOBAL_STATS_VIEW}
+        )).scalar() is not None
+    return GLOBAL_STATS_READY
+
+
+@app.on_event("startup")
+async def on_startup():
+    # Banco indisponível no boot: sobe sem whitelist; POST /admin/refresh-schema recarrega
+    try:
+        await load_schema()
+    except Exception as e:
+        print(f"Aviso: não foi possível carregar o schema de sp_setores: {e}")
+    # Banco recém-criado (ETL ainda não rodou) ou indisponível no boot: sobe com LINES vazio;
+    # POST /admin/refresh-schema carrega as linhas depois do ETL
+    try:
+        await load_lines()
+    except Exception as e:
+        print(f"Aviso: não foi possível carregar as linhas de metrô: {e}")
+    try:
+        await check_global_stats()
+    except Exception as e:
+        print(f"Aviso: não foi possível verificar {GLOBAL_STATS_VIEW}: {e}")
+
+
+@app.post("/admin/refresh-schema")
+async def refresh_schema():
+    cols = await load_schema()
+    lines = await load_lines()
+    await check_global_stats()
+    _metrics_cache.clear()
+    _stats_cache.clear()
+    return {"columns": len(cols), "lines": len(lines)}
+
 
 @app.get("/")
-def read_root():
+async def read_root():
     return {"message": "Bem-vindo à API Geo. Acesse /docs para ver a documentação."}
 
 
 @app.get("/heatmap", response_class=Response)
-def get_heatmap(
+async def get_heatmap(
     metric: str = Query("distancia_metro_m"),
     bbox: Optional[str] = Query(None, description="minLon,minLat,maxLon,maxLat"),
     simplify: Optional[float] = Query(None, gt=0, description="tolerância de simplificação em graus"),
-    limit: Optional[int] = Query(None, gt=0, le=50000, description="limite máximo de features")
+    limit: Optional[int] = Query(None, gt=0, le=50000, description="limite máximo de features"),
+    exact: bool = Query(False, description="filtro bbox exato (ST_Intersects) em vez de caixa envolvente (&&)")
 ):
   
     print(f"Requisição recebida para a métrica: {metric}")
     
-    # Verifica se a coluna existe na tabela alvo (whitelist dinâmica)
-    with engine.connect() as conn:
-        exists = conn.execute(text(
-            """
-            SELECT 1 FROM information_schema.columns
-            WHERE table_schema='public' AND table_name='sp_setores' AND column_name = :metric
-            """
-        ), {"metric": metric}).fetchone()
-        if not exists:
-            raise HTTPException(status_code=400, detail=f"Métrica '{metric}' não disponível na tabela.")
+    # Verifica se a coluna existe na tabela alvo (whitelist do schema em cache)
+    if not await has_columns(metric):
+        raise HTTPException(status_code=400, detail=f"Métrica '{metric}' não disponível na tabela.")
 
-    # Montagem dinâmica segura
-    geom_expr = "geom"
+    # Montagem dinâmica segura: usa o nível de detalhe pré-calculado mais próximo (até 2x de
+    # diferença na tolerância); fora da grade, simplifica em tempo de requisição
+    lod_col = None
     if simplify is not None:
-        geom_expr = f"ST_SimplifyPreserveTopology(geom, :simplify) AS geom"
+        tol = min(LOD_BY_TOLERANCE, key=lambda t: abs(math.log(simplify / t)))
+        if 0.5 <= simplify / tol <= 2.0:
+            lod_col = LOD_BY_TOLERANCE[tol]
+    if lod_col is not None:
+        geom_expr = lod_col
+    elif simplify is not None:
+        geom_expr = "ST_SimplifyPreserveTopology(geom, :simplify)"
     else:
         geom_expr = "geom"
 
     where_clauses = [f'"{metric}" IS NOT NULL']
-    params = {}
-    if simplify is not None:
+    params = {"metric_name": metric}
+    if simplify is not None and lod_col is None:
         params["simplify"] = float(simplify)
 
     # Aplica filtro espacial por bbox se informado
     if bbox:
-        try:
-            parts = [float(x) for x in bbox.split(',')]
-            if len(parts) != 4:
-                raise ValueError("bbox deve ter 4 números")
-            minx, miny, maxx, maxy = parts
-            # sanity check
-            if not (-180 <= minx <= 180 and -90 <= miny <= 90 and -180 <= maxx <= 180 and -90 <= maxy <= 90):
-                raise ValueError("bbox inválido")
-            where_clauses.append("ST_Intersects(geom, ST_MakeEnvelope(:minx, :miny, :maxx, :maxy, 4326))")
-            params.update({"minx": minx, "miny": miny, "maxx": maxx, "maxy": maxy})
-        except Exception as e:
-            raise HTTPException(status_code=400, detail=f"Parâmetro bbox inválido: {e}")
+        params.update(parse_bbox(bbox))
+        where_clauses.append(bbox_filter_sql(exact))
 
     where_sql = " AND ".join(where_clauses)
     limit_sql = f" LIMIT {int(limit)}" if limit else ""
 
-    sql_query = f"""
-        SELECT "CD_SETOR" as id, "{metric}", {geom_expr}
+    rows_sql = f"""
+        SELECT "CD_SETOR" AS id, "{metric}" AS value, {geom_expr} AS geom
         FROM sp_setores
         WHERE {where_sql}
         {limit_sql}
     """
-    
-    try:
-        # Lê os dados do PostGIS usando GeoPandas (geom nativo)
-        gdf = gpd.read_postgis(text(sql_query), engine, geom_col='geom', params=params)
-        
-        # Converte o GeoDataFrame para uma string GeoJSON
-        geojson_str = gdf.to_json()
-        
-        # Retorna a resposta como GeoJSON
-        return Response(content=geojson_str, media_type="application/json")
+    sql_query = feature_rows_sql(
+        rows_sql, "json_build_object('id', t.id, CAST(:metric_name AS text), t.value)", id_sql="t.id"
+    )
 
+    # Features serializadas pelo PostGIS e lidas por cursor no servidor: o FeatureCollection
+    # é transmitido em blocos, sem ficar inteiro na memória da API nem do banco
+    conn = await engine.connect()
+    try:
+        result = await conn.stream(text(sql_query), params)
     except Exception as e:
+        await conn.close()
         print(f"Erro ao consultar o banco: {e}")
         raise HTTPException(status_code=500, detail="Erro interno ao processar a solicitação.")
 
+    async def generate():
+        try:
+            yield b'{"type":"FeatureCollection","features":['
+            sep = b""
+            async for rows in result.partitions(2000):
+                yield sep + b",".join(r[0].encode() for r in rows)
+                sep = b","
+            yield b"]}"
+        finally:
+            # shield: o close não é interrompido quando o streaming é cancelado
+            await asyncio.shield(conn.close())
+
+    # A conexão volta ao pool também pela background task, que roda mesmo quando o cliente
+    # desconecta antes de o gerador começar (close é idempotente)
+    return StreamingResponse(
+        generate(), media_type="application/geo+json", background=BackgroundTask(conn.close)
+    )
+
 
 @app.get("/metrics")
-def list_metrics():
+async def list_metrics():
     """
     Lista as métricas suportadas e a cobertura (linhas não nulas) em sp_setores.
     """
+    if None in _metrics_cache:
+        return _metrics_cache[None]
     results = []
-    with engine.connect() as conn:
-        # total de linhas na tabela
-        total = conn.execute(text("SELECT COUNT(*) FROM sp_setores")).scalar() or 0
+    # Novas colunas distancia_metro_* do ETL: relê o schema a cada reconstrução da lista
+    try:
+        await load_schema()
+    except Exception as e:
+        print(f"Aviso: não foi possível recarregar o schema de sp_setores: {e}")
+    # Existência das colunas e métricas dinâmicas de distância por linha vêm do schema
+    dyn_metrics = [c for c in ALLOWED_COLUMNS if c.startswith("distancia_metro_")]
+    metrics = sorted(set(ALLOWED_METRICS + dyn_metrics))
+    existing = [m for m in metrics if m in ALLOWED_COLUMNS]
+
+    async with engine.connect() as conn:
+        # Total e não nulos de todas as métricas numa única varredura (count FILTER)
+        # Nota: não é possível parametrizar o nome da coluna; só entram colunas existentes
+        filters_sql = "".join(
+            f', COUNT(*) FILTER (WHERE "{m}" IS NOT NULL) AS c{i}' for i, m in enumerate(existing)
+        )
+        counts = (await conn.execute(text(f"SELECT COUNT(*) AS total{filters_sql} FROM sp_setores"))).mappings().one()
 
-        # Descobre métricas dinâmicas de distância por linha
-        dyn_cols = conn.execute(text(
-            """
-            SELECT column_name FROM information_schema.columns
-            WHERE table_schema='public' AND table_name='sp_setores' AND column_name LIKE 'distancia_metro_%'
-            """
-        )).fetchall()
-        dyn_metrics = [r[0] for r in dyn_cols]
-
-        for metric in sorted(set(ALLOWED_METRICS + dyn_metrics)):
-            # checa existência da coluna
-            exists = conn.execute(
-                text(
-                    """
-                    SELECT 1 FROM information_schema.columns
-                    WHERE table_schema='public' AND table_name='sp_setores' AND column_name = :metric
-                    """
-                ),
-                {"metric": metric},
-            ).fetchone() is not None
-
-            non_null = 0
-            if exists and total > 0:
-                # conta valores não nulos da métrica
-                # Nota: não é possível parametrizar o nome da coluna; garantimos segurança via lista ALLOWED_METRICS
-                count_sql = text(f'SELECT COUNT(*) FROM sp_setores WHERE "{metric}" IS NOT NULL')
-                non_null = conn.execute(count_sql).scalar() or 0
-
-            coverage_pct = (non_null / total * 100.0) if total > 0 else 0.0
-
-            results.append({
-                "metric": metric,
-                "exists": exists,
-                "non_null": int(non_null),
-                "total": int(total),
-                "coverage_pct": round(coverage_pct, 2),
-            })
-
-    return {"metrics": results}
+    total = counts["total"] or 0
+    non_null_by_metric = {m: counts[f"c{i}"] for i, m in enumerate(existing)}
+    for metric in metrics:
+        non_null = non_null_by_metric.get(metric, 0)
+        coverage_pct = (non_null / total * 100.0) if total > 0 else 0.0
+
+        results.append({
+            "metric": metric,
+            "exists": metric in non_null_by_metric,
+            "non_null": int(non_null),
+            "total": int(total),
+            "coverage_pct": round(coverage_pct, 2),
+        })
+
+    _metrics_cache[None] = {"metrics": results}
+    return _metrics_cache[None]
 
 
 @app.get("/stats")
-def stats(
+async def stats(
     bbox: Optional[str] = Query(None, description="minLon,minLat,maxLon,maxLat"),
     sample_limit: int = Query(800, gt=50, le=5000),
     bins: int = Query(8, gt=3, le=20, description="número de faixas para médias por distância"),
     bin_mode: str = Query("width", pattern="^(width|quantile)$", description="método de bins: width (largura igual) ou quantile"),
     renda_metric: str = Query("vl_renda"),
-    dist_metric: str = Query("distancia_metro_m")
+    dist_metric: str = Query("distancia_metro_m"),
+    exact: bool = Query(False, description="filtro bbox exato (ST_Intersects) em vez de caixa envolvente (&&)")
 ):
     """
     Estatísticas entre vl_renda e distancia_metro_m na área (bbox):
@@ -178,19 +433,17 @@ def stats(
     - r: correlação de Pearson (vl_renda vs distancia_metro_m)
     - pairs: amostra de pares [vl_renda, distancia_metro_m]
     """
-    # Validação de colunas (whitelist dinâmica via information_schema)
+    global GLOBAL_STATS_READY
+    cache_key = (bbox, sample_limit, bins, bin_mode, renda_metric, dist_metric, exact)
+    if cache_key in _stats_cache:
+        return ORJSONResponse(_stats_cache[cache_key])
+
+    # Validação de colunas (whitelist do schema em cache)
     safe_name = lambda s: isinstance(s, str) and len(s) <= 64 and s.replace('_','').isalnum()
     if not (safe_name(renda_metric) and safe_name(dist_metric)):
         raise HTTPException(status_code=400, detail="Nomes de colunas inválidos.")
-    with engine.connect() as conn:
-        chk = conn.execute(text(
-            """
-            SELECT column_name FROM information_schema.columns
-            WHERE table_schema='public' AND table_name='sp_setores' AND column_name IN (:r,:d)
-            """
-        ), {"r": renda_metric, "d": dist_metric}).fetchall()
-        if len(chk) < 2:
-            raise HTTPException(status_code=400, detail="Coluna de renda ou distância não existe em sp_setores.")
+    if not await has_columns(renda_metric, dist_metric):
+        raise HTTPException(status_code=400, detail="Coluna de renda ou distância não existe em sp_setores.")
 
     renda_col = f'"{renda_metric}"'
     dist_col = f'"{dist_metric}"'
@@ -199,279 +452,55 @@ def stats(
     params = {}
 
     if bbox:
-        try:
-            parts = [float(x) for x in bbox.split(',')]
-            if len(parts) != 4:
-                raise ValueError("bbox deve ter 4 números")
-            minx, miny, maxx, maxy = parts
-            if not (-180 <= minx <= 180 and -90 <= miny <= 90 and -180 <= maxx <= 180 and -90 <= maxy <= 90):
-                raise ValueError("bbox inválido")
-            where_clauses.append("ST_Intersects(geom, ST_MakeEnvelope(:minx, :miny, :maxx, :maxy, 4326))")
-            params.update({"minx": minx, "miny": miny, "maxx": maxx, "maxy": maxy})
-        except Exception as e:
-            raise HTTPException(status_code=400, detail=f"Parâmetro bbox inválido: {e}")
+        params.update(parse_bbox(bbox))
+        where_clauses.append(bbox_filter_sql(exact))
 
     where_sql = " AND ".join(where_clauses)
 
-    # Agregados estatísticos (usa corr do PostgreSQL)
-    agg_sql = text(
-        f"""
-        WITH s AS (
-            SELECT {renda_col}::float8 AS renda, {dist_col}::float8 AS dist, "CD_MUN"::text AS cd_mun
-            FROM sp_setores
-            WHERE {where_sql}
-        )
-        SELECT COUNT(*) AS n,
-               corr(renda, dist) AS r,
-               MIN(renda) AS renda_min, MAX(renda) AS renda_max,
-               MIN(dist) AS dist_min, MAX(dist) AS dist_max
-        FROM s
-        """
-    )
-    # Spearman via ranks
-    spear_sql = text(
-        f"""
-        WITH s AS (
-            SELECT {renda_col}::float8 AS renda, {dist_col}::float8 AS dist
-            FROM sp_setores
-            WHERE {where_sql}
-        ), r AS (
-            SELECT PERCENT_RANK() OVER (ORDER BY renda) AS renda_rnk,
-                   PERCENT_RANK() OVER (ORDER BY dist)  AS dist_rnk
-            FROM s
-        )
-        SELECT corr(renda_rnk, dist_rnk) AS r_s FROM r
-        """
-    )
-    # Correlação após remover efeito fixo municipal (demeaning por CD_MUN)
-    demean_sql = text(
-        f"""
-        WITH s AS (
-            SELECT {renda_col}::float8 AS renda, {dist_col}::float8 AS dist, "CD_MUN"::text AS cd_mun
-            FROM sp_setores
-            WHERE {where_sql}
-        ), m AS (
-            SELECT cd_mun, AVG(renda) AS renda_m, AVG(dist) AS dist_m FROM s GROUP BY cd_mun
-        ), j AS (
-            SELECT (s.renda - m.renda_m) AS renda_res,
-                   (s.dist  - m.dist_m)  AS dist_res
-            FROM s JOIN m USING (cd_mun)
-        )
-        SELECT COUNT(*) AS n_res, corr(renda_res, dist_res) AS r_res FROM j
-        """
-    )
-    # Spearman nos residuais
-    spear_demean_sql = text(
-        f"""
-        WITH s AS (
-            SELECT {renda_col}::float8 AS renda, {dist_col}::float8 AS dist, "CD_MUN"::text AS cd_mun
-            FROM sp_setores
-            WHERE {where_sql}
-        ), m AS (
-            SELECT cd_mun, AVG(renda) AS renda_m, AVG(dist) AS dist_m FROM s GROUP BY cd_mun
-        ), j AS (
-            SELECT (s.renda - m.renda_m) AS renda_res,
-                   (s.dist  - m.dist_m)  AS dist_res
-            FROM s JOIN m USING (cd_mun)
-        ), r AS (
-            SELECT PERCENT_RANK() OVER (ORDER BY renda_res) AS rr,
-                   PERCENT_RANK() OVER (ORDER BY dist_res)  AS dr
-            FROM j
-        )
-        SELECT corr(rr, dr) AS r_s_res FROM r
-        """
-    )
-    # Amostra de pares
-    sample_sql = text(
-        f"""
-    SELECT {renda_col}::float8 AS renda, {dist_col}::float8 AS dist
-        FROM sp_setores
-        WHERE {where_sql}
-        ORDER BY random()
-        LIMIT :lim
-        """
-    )
-    # Bins por distância - largura igual
-    bins_width_sql = text(
-        f"""
-        WITH s AS (
-            SELECT {renda_col}::float8 AS renda, {dist_col}::float8 AS dist
-            FROM sp_setores
-            WHERE {where_sql}
-        ), ext AS (
-            SELECT MIN(dist) AS min_d, MAX(dist) AS max_d FROM s
-        ), params AS (
-            SELECT CAST(:bins AS int) AS bins
-        ), edges AS (
-            SELECT i AS bin,
-                   ext.min_d + i * (ext.max_d - ext.min_d) / NULLIF(params.bins, 0) AS min_edge,
-                   ext.min_d + (i+1) * (ext.max_d - ext.min_d) / NULLIF(params.bins, 0) AS max_edge,
-                   params.bins
-            FROM generate_series(0, (SELECT bins-1 FROM params)) i, ext, params
-        )
-        SELECT e.bin::int,
-               e.min_edge,
-               e.max_edge,
-               COUNT(s.*)             AS n,
-               AVG(s.renda)           AS renda_avg,
-               AVG(s.dist)            AS dist_avg
-        FROM edges e
-        LEFT JOIN s
-          ON s.dist >= e.min_edge AND (s.dist < e.max_edge OR (e.bin = e.bins-1 AND s.dist <= e.max_edge))
-        GROUP BY e.bin, e.min_edge, e.max_edge
-        ORDER BY e.bin
-        """
-    )
-    # Bins por distância - quantis (ntile)
-    bins_quant_sql = text(
-        f"""
-        WITH s AS (
-            SELECT {renda_col}::float8 AS renda, {dist_col}::float8 AS dist
-            FROM sp_setores
-            WHERE {where_sql}
-        ), r AS (
-            SELECT renda, dist, NTILE(:bins) OVER (ORDER BY dist) AS bin
-            FROM s
-        )
-        SELECT bin::int,
-               MIN(dist) AS min_edge,
-               MAX(dist) AS max_edge,
-               COUNT(*)  AS n,
-               AVG(renda) AS renda_avg,
-               AVG(dist)  AS dist_avg
-        FROM r
-        GROUP BY bin
-        ORDER BY bin
-        """
-    )
-    # Bins intra (demeaned) - largura igual
-    bins_demean_width_sql = text(
-        f"""
-        WITH s AS (
-            SELECT {renda_col}::float8 AS renda, {dist_col}::float8 AS dist, "CD_MUN"::text AS cd_mun
-            FROM sp_setores
-            WHERE {where_sql}
-        ), m AS (
-            SELECT cd_mun, AVG(renda) AS renda_m, AVG(dist) AS dist_m FROM s GROUP BY cd_mun
-        ), j AS (
-            SELECT (s.renda - m.renda_m) AS renda_res,
-                   (s.dist  - m.dist_m)  AS dist_res
-            FROM s JOIN m USING (cd_mun)
-        ), ext AS (
-            SELECT MIN(dist_res) AS min_d, MAX(dist_res) AS max_d FROM j
-        ), params AS (
-            SELECT CAST(:bins AS int) AS bins
-        ), edges AS (
-            SELECT i AS bin,
-                   ext.min_d + i * (ext.max_d - ext.min_d) / NULLIF(params.bins, 0) AS min_edge,
-                   ext.min_d + (i+1) * (ext.max_d - ext.min_d) / NULLIF(params.bins, 0) AS max_edge,
-                   params.bins
-            FROM generate_series(0, (SELECT bins-1 FROM params)) i, ext, params
-        )
-        SELECT e.bin::int,
-               e.min_edge,
-               e.max_edge,
-               COUNT(j.*)               AS n,
-               AVG(j.renda_res)         AS renda_avg,
-               AVG(j.dist_res)          AS dist_avg
-        FROM edges e
-        LEFT JOIN j
-          ON j.dist_res >= e.min_edge AND (j.dist_res < e.max_edge OR (e.bin = e.bins-1 AND j.dist_res <= e.max_edge))
-        GROUP BY e.bin, e.min_edge, e.max_edge
-        ORDER BY e.bin
-        """
-    )
-    # Bins intra (demeaned) - quantis
-    bins_demean_quant_sql = text(
-        f"""
-        WITH s AS (
-            SELECT {renda_col}::float8 AS renda, {dist_col}::float8 AS dist, "CD_MUN"::text AS cd_mun
-            FROM sp_setores
-            WHERE {where_sql}
-        ), m AS (
-            SELECT cd_mun, AVG(renda) AS renda_m, AVG(dist) AS dist_m FROM s GROUP BY cd_mun
-        ), j AS (
-            SELECT (s.renda - m.renda_m) AS renda_res,
-                   (s.dist  - m.dist_m)  AS dist_res
-            FROM s JOIN m USING (cd_mun)
-        ), r AS (
-            SELECT renda_res, dist_res, NTILE(:bins) OVER (ORDER BY dist_res) AS bin
-            FROM j
-        )
-        SELECT bin::int,
-               MIN(dist_res) AS min_edge,
-               MAX(dist_res) AS max_edge,
-               COUNT(*)      AS n,
-               AVG(renda_res) AS renda_avg,
-               AVG(dist_res)  AS dist_avg
-        FROM r
-        GROUP BY bin
-        ORDER BY bin
-        """
-    )
-    # Correlação intermunicipal (between)
-    between_sql = text(
-        f"""
-        WITH s AS (
-            SELECT "vl_renda"::float8 AS renda, "distancia_metro_m"::float8 AS dist, "CD_MUN"::text AS cd_mun
-            FROM sp_setores
-            WHERE {where_sql}
-        ), m AS (
-            SELECT cd_mun, AVG(renda) AS renda_m, AVG(dist) AS dist_m FROM s GROUP BY cd_mun
-        )
-        SELECT COUNT(*) AS n_mun, corr(renda_m, dist_m) AS r_between FROM m
-        """
-    )
-    between_spear_sql = text(
-        f"""
-        WITH s AS (
-            SELECT "vl_renda"::float8 AS renda, "distancia_metro_m"::float8 AS dist, "CD_MUN"::text AS cd_mun
-            FROM sp_setores
-            WHERE {where_sql}
-        ), m AS (
-            SELECT cd_mun, AVG(renda) AS renda_m, AVG(dist) AS dist_m FROM s GROUP BY cd_mun
-        ), r AS (
-            SELECT PERCENT_RANK() OVER (ORDER BY renda_m) AS rr,
-                   PERCENT_RANK() OVER (ORDER BY dist_m)  AS dr
-            FROM m
-        )
-        SELECT corr(rr, dr) AS r_s_between FROM r
-        """
-    )
-
-    with engine.connect() as conn:
-        agg_row = conn.execute(agg_sql, params).mappings().first()
-        spear_row = conn.execute(spear_sql, params).mappings().first()
-        demean_row = conn.execute(demean_sql, params).mappings().first()
-        spear_demean_row = conn.execute(spear_demean_sql, params).mappings().first()
-        params2 = dict(params)
-        params2["lim"] = int(sample_limit)
-        pairs = conn.execute(sample_sql, params2).fetchall()
-        params3 = dict(params)
-        params3["bins"] = int(bins)
-        if bin_mode == "quantile":
-            bins_rows = conn.execute(bins_quant_sql, params3).mappings().all()
-            bins_demean_rows = conn.execute(bins_demean_quant_sql, params3).mappings().all()
-        else:
-            bins_rows = conn.execute(bins_width_sql, params3).mappings().all()
-            bins_demean_rows = conn.execute(bins_demean_width_sql, params3).mappings().all()
-
-        between_row = conn.execute(between_sql, params).mappings().first()
-        between_spear_row = conn.execute(between_spear_sql, params).mappings().first()
+    requested = {
+        "sample_limit": sample_limit, "bins": bins, "bin_mode": bin_mode,
+        "renda_metric": renda_metric, "dist_metric": dist_metric,
+    }
+    params["lim"] = int(sample_limit)
+    params["bins"] = int(bins)
+    st = None
+    use_view = not bbox and requested == GLOBAL_STATS_DEFAULTS
+    if use_view and not GLOBAL_STATS_READY and time.monotonic() - _global_stats_checked_at >= SCHEMA_RELOAD_INTERVAL:
+        try:
+            await check_global_stats()
+        except Exception as e:
+            print(f"Aviso: não foi possível verificar {GLOBAL_STATS_VIEW}: {e}")
+    async with engine.connect() as conn:
+        if use_view and GLOBAL_STATS_READY:
+            # Sem filtro e com os padrões: lê a materialized view em vez de agregar a tabela inteira
+            try:
+                st = json.loads((await conn.execute(
+                    text(f"SELECT stats_json::text AS stats FROM {GLOBAL_STATS_VIEW}")
+                )).scalar_one())
+            except Exception as e:
+                # View removida pelo ETL (load_geography.py): agrega ao vivo até que
+                # create_features.py/load_census.py a recriem
+                print(f"Aviso: falha ao ler {GLOBAL_STATS_VIEW}, usando agregação direta: {e}")
+                GLOBAL_STATS_READY = False
+                await conn.rollback()
+        if st is None:
+            stats_sql = build_stats_sql(renda_col, dist_col, where_sql, bin_mode)
+            st = json.loads((await conn.execute(stats_sql, params)).scalar_one())
 
     result = {
-        "count": int(agg_row["n"]) if agg_row and agg_row["n"] is not None else 0,
-        "r": float(agg_row["r"]) if agg_row and agg_row["r"] is not None else None,
-        "r_s": float(spear_row["r_s"]) if spear_row and spear_row["r_s"] is not None else None,
-        "r_demeaned": float(demean_row["r_res"]) if demean_row and demean_row["r_res"] is not None else None,
-        "r_s_demeaned": float(spear_demean_row["r_s_res"]) if spear_demean_row and spear_demean_row["r_s_res"] is not None else None,
-    "r_between": float(between_row["r_between"]) if between_row and between_row["r_between"] is not None else None,
-    "r_s_between": float(between_spear_row["r_s_between"]) if between_spear_row and between_spear_row["r_s_between"] is not None else None,
-        "renda_min": float(agg_row["renda_min"]) if agg_row and agg_row["renda_min"] is not None else None,
-        "renda_max": float(agg_row["renda_max"]) if agg_row and agg_row["renda_max"] is not None else None,
-        "dist_min": float(agg_row["dist_min"]) if agg_row and agg_row["dist_min"] is not None else None,
-        "dist_max": float(agg_row["dist_max"]) if agg_row and agg_row["dist_max"] is not None else None,
-        "pairs": [[float(r), float(d)] for (r, d) in pairs],
+        "count": int(st["n"]) if st["n"] is not None else 0,
+        "r": pearson_from_sums(*st["sums"]),
+        "r_s": float(st["r_s"]) if st["r_s"] is not None else None,
+        "r_demeaned": pearson_from_sums(*st["sums_res"]),
+        "r_s_demeaned": float(st["r_s_res"]) if st["r_s_res"] is not None else None,
+        "r_between": pearson_from_sums(*st["sums_between"]),
+        "r_s_between": float(st["r_s_between"]) if st["r_s_between"] is not None else None,
+        "renda_min": float(st["renda_min"]) if st["renda_min"] is not None else None,
+        "renda_max": float(st["renda_max"]) if st["renda_max"] is not None else None,
+        "dist_min": float(st["dist_min"]) if st["dist_min"] is not None else None,
+        "dist_max": float(st["dist_max"]) if st["dist_max"] is not None else None,
+        # array (n, 2) serializado direto pelo orjson
+        "pairs": np.array(st["pairs"], dtype=np.float64).reshape(-1, 2),
         "bins": [
             {
                 "bin": int(row["bin"]),
@@ -481,7 +510,7 @@ def stats(
                 "renda_avg": float(row["renda_avg"]) if row["renda_avg"] is not None else None,
                 "dist_avg": float(row["dist_avg"]) if row["dist_avg"] is not None else None,
             }
-            for row in bins_rows
+            for row in st["bins_rows"]
         ],
         "bins_demeaned": [
             {
@@ -492,98 +521,89 @@ def stats(
                 "renda_avg": float(row["renda_avg"]) if row["renda_avg"] is not None else None,
                 "dist_avg": float(row["dist_avg"]) if row["dist_avg"] is not None else None,
             }
-            for row in bins_demean_rows
+            for row in st["bins_demean_rows"]
         ],
     }
-    return result
+    _stats_cache[cache_key] = result
+    # Resposta direta: o jsonable_encoder do FastAPI não aceita ndarray
+    return ORJSONResponse(result)
 
 
 @app.get("/stations", response_class=Response)
-def get_stations(
+async def get_stations(
     bbox: Optional[str] = Query(None, description="minLon,minLat,maxLon,maxLat"),
-    limit: Optional[int] = Query(2000, gt=0, le=10000)
+    limit: Optional[int] = Query(2000, gt=0, le=10000),
+    exact: bool = Query(False, description="filtro bbox exato (ST_Intersects) em vez de caixa envolvente (&&)")
 ):
     """Retorna estações de metrô como GeoJSON com filtro opcional por bbox."""
+    await ensure_lines()
     where = []
     params = {}
     if bbox:
-        try:
-            parts = [float(x) for x in bbox.split(',')]
-            if len(parts) != 4:
-                raise ValueError("bbox deve ter 4 números")
-            minx, miny, maxx, maxy = parts
-            if not (-180 <= minx <= 180 and -90 <= miny <= 90 and -180 <= maxx <= 180 and -90 <= maxy <= 90):
-                raise ValueError("bbox inválido")
-            where.append("ST_Intersects(geom, ST_MakeEnvelope(:minx, :miny, :maxx, :maxy, 4326))")
-            params.update({"minx": minx, "miny": miny, "maxx": maxx, "maxy": maxy})
-        except Exception as e:
-            raise HTTPException(status_code=400, detail=f"Parâmetro bbox inválido: {e}")
+        params.update(parse_bbox(bbox))
+        where.append(bbox_filter_sql(exact))
 
     where_sql = ("WHERE " + " AND ".join(where)) if where else ""
     lim_sql = f" LIMIT {int(limit)}" if limit else ""
 
-    sql = f"""
-        SELECT *
-        FROM pois_metro_sp
+    # properties = colunas de atributos (lista do catálogo, sem colunas geométricas)
+    attrs_sql = ", ".join('p."{}"'.format(c.replace('"', '""')) for c in STATION_COLUMNS)
+    rows_sql = f"""
+        SELECT to_jsonb(a) AS props, p.geom
+        FROM pois_metro_sp p
+        CROSS JOIN LATERAL (SELECT {attrs_sql}) a
         {where_sql}
         {lim_sql}
     """
+    sql = feature_collection_sql(rows_sql, "t.props")
     try:
-        gdf = gpd.read_postgis(text(sql), engine, geom_col='geom', params=params)
-        return Response(content=gdf.to_json(), media_type="application/json")
+        async with engine.connect() as conn:
+            geojson_str = (await conn.execute(text(sql), params)).scalar()
+        return Response(content=geojson_str, media_type="application/geo+json")
     except Exception as e:
         print(f"Erro ao consultar estações: {e}")
         raise HTTPException(status_code=500, detail="Erro interno ao processar estações.")
 
 
 @app.get("/points", response_class=Response)
-def get_points(
+async def get_points(
     metric: str = Query("distancia_metro_m"),
     bbox: Optional[str] = Query(None, description="minLon,minLat,maxLon,maxLat"),
     limit: Optional[int] = Query(20000, ge=50, le=100000, description="limite de pontos"),
-    snap: Optional[float] = Query(None, gt=0, description="tamanho da grade em graus para agregar pontos (ST_SnapToGrid)")
+    snap: Optional[float] = Query(None, gt=0, description="tamanho da grade em graus para agregar pontos (ST_SnapToGrid)"),
+    exact: bool = Query(False, description="filtra pelo polígono do setor (ST_Intersects) em vez do ponto representativo")
 ):
     """Retorna pontos (centróides) de setores com a métrica solicitada para visualização leve."""
     # validar coluna
-    with engine.connect() as conn:
-        exists = conn.execute(text(
-            """
-            SELECT 1 FROM information_schema.columns
-            WHERE table_schema='public' AND table_name='sp_setores' AND column_name = :metric
-            """
-        ), {"metric": metric}).fetchone()
-        if not exists:
-            raise HTTPException(status_code=400, detail=f"Métrica '{metric}' não disponível em sp_setores.")
+    if not await has_columns(metric):
+        raise HTTPException(status_code=400, detail=f"Métrica '{metric}' não disponível em sp_setores.")
 
     where = [f'"{metric}" IS NOT NULL']
     params = {}
     if bbox:
-        try:
-            parts = [float(x) for x in bbox.split(',')]
-            if len(parts) != 4:
-                raise ValueError("bbox deve ter 4 números")
-            minx, miny, maxx, maxy = parts
-            if not (-180 <= minx <= 180 and -90 <= miny <= 90 and -180 <= maxx <= 180 and -90 <= maxy <= 90):
-                raise ValueError("bbox inválido")
-            where.append("ST_Intersects(geom, ST_MakeEnvelope(:minx, :miny, :maxx, :maxy, 4326))")
-            params.update({"minx": minx, "miny": miny, "maxx": maxx, "maxy": maxy})
-        except Exception as e:
-            raise HTTPException(status_code=400, detail=f"Parâmetro bbox inválido: {e}")
+        params.update(parse_bbox(bbox))
+        # Padrão: geom_pt (ST_PointOnSurface pré-calculado por create_features.py); `&&` num
+        # ponto já é exato e usa o índice GiST de pontos, menor que o dos polígonos.
+        # exact=True mantém o teste original sobre o polígono (setores que tocam o bbox)
+        if exact:
+            where.append(bbox_filter_sql(exact))
+        else:
+            where.append("geom_pt && ST_MakeEnvelope(:minx, :miny, :maxx, :maxy, 4326)")
 
     where_sql = ("WHERE " + " AND ".join(where)) if where else ""
     lim_sql = f" LIMIT {int(limit)}" if limit else ""
     if snap is None:
-        sql = f"""
-            SELECT "CD_SETOR" AS id, "{metric}" AS value, ST_PointOnSurface(geom) AS geom
+        rows_sql = f"""
+            SELECT "CD_SETOR" AS id, "{metric}" AS value, geom_pt AS geom
             FROM sp_setores
             {where_sql}
             {lim_sql}
         """
     else:
-        sql = f"""
+        rows_sql = f"""
             WITH s AS (
                 SELECT "{metric}"::float8 AS value,
-                       ST_SnapToGrid(ST_PointOnSurface(geom), :snap) AS g
+                       ST_SnapToGrid(geom_pt, :snap) AS g
                 FROM sp_setores
                 {where_sql}
                 {lim_sql}
@@ -594,9 +614,11 @@ def get_points(
             FROM s
             GROUP BY g
         """
+    # properties[metric] para manter compatibilidade com o front
+    sql = feature_collection_sql(rows_sql, "json_build_object('id', t.id, CAST(:metric_name AS text), t.value)")
     try:
         # inclui bind para :snap quando solicitado
-        params_exec = dict(params)
+        params_exec = dict(params, metric_name=metric)
         if snap is not None:
             params_exec["snap"] = float(snap)
         # debug leve
@@ -604,41 +626,65 @@ def get_points(
             print(f"/points params -> keys: {list(params_exec.keys())}, snap={params_exec.get('snap')}")
         except Exception:
             pass
-        gdf = gpd.read_postgis(text(sql), engine, geom_col='geom', params=params_exec)
-        # renomear para manter compatibilidade com front (properties[metric])
-        if 'value' in gdf.columns:
-            gdf.rename(columns={'value': metric}, inplace=True)
-        return Response(content=gdf.to_json(), media_type="application/json")
+        async with engine.connect() as conn:
+            geojson_str = (await conn.execute(text(sql), params_exec)).scalar()
+        return Response(content=geojson_str, media_type="application/geo+json")
     except Exception as e:
         print(f"Erro ao consultar pontos: {e}")
         raise HTTPException(status_code=500, detail="Erro interno ao processar pontos.")
 
 
+@app.get("/tiles/{z}/{x}/{y}.mvt", response_class=Response)
+async def get_tile(
+    z: int,
+    x: int,
+    y: int,
+    metric: str = Query("distancia_metro_m"),
+):
+    """
+    Vector tile (MVT) dos setores com a métrica solicitada, camada 'setores' com
+    propriedades id e value. Usa geom_3857 (pré-projetada por create_features.py).
+    """
+    if not (0 <= z <= 22 and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        raise HTTPException(status_code=400, detail="Tile inválido.")
+    if not await has_columns(metric):
+        raise HTTPException(status_code=400, detail=f"Métrica '{metric}' não disponível em sp_setores.")
+
+    # Simplifica em ~1 pixel do tile (extent 4096) antes de recortar
+    tol = WEB_MERCATOR_SIZE / 2 ** z / 4096
+    sql = text(
+        f"""
+        WITH bounds AS (
+            SELECT ST_TileEnvelope(:z, :x, :y) AS geom
+        ), mvtgeom AS (
+            SELECT ST_AsMVTGeom(ST_Simplify(s.geom_3857, :tol, true), bounds.geom) AS geom,
+                   s."CD_SETOR" AS id,
+                   s."{metric}"::float8 AS value
+            FROM sp_setores s, bounds
+            WHERE s.geom_3857 && bounds.geom AND s."{metric}" IS NOT NULL
+        )
+        SELECT ST_AsMVT(mvtgeom, 'setores') FROM mvtgeom
+        """
+    )
+    try:
+        async with engine.connect() as conn:
+            tile = (await conn.execute(sql, {"z": z, "x": x, "y": y, "tol": tol})).scalar()
+        return Response(content=bytes(tile or b""), media_type="application/vnd.mapbox-vector-tile")
+    except Exception as e:
+        print(f"Erro ao gerar tile: {e}")
+        raise HTTPException(status_code=500, detail="Erro interno ao gerar o tile.")
+
+
 @app.get("/lines")
-def list_lines():
-    with engine.connect() as conn:
-        rows = conn.execute(text("SELECT DISTINCT emt_linha FROM pois_metro_sp WHERE emt_linha IS NOT NULL ORDER BY 1"))
-        return {"lines": [r[0] for r in rows]}
+async def list_lines():
+    await ensure_lines()
+    return {"lines": LINES}
 
 
 @app.get("/line_extent")
-def line_extent(linha: str = Query(..., description="nome da linha em maiúsculas (ex.: LILAS)")):
-    with engine.connect() as conn:
-        row = conn.execute(text(
-            """
-            SELECT ST_Extent(geom) AS e
-            FROM pois_metro_sp
-            WHERE emt_linha = :linha
-            """
-        ), {"linha": linha}).first()
-        if not row or not row[0]:
-            raise HTTPException(status_code=404, detail="Linha não encontrada.")
-        # ST_Extent retorna BOX(minx miny,maxx maxy)
-        extent = row[0]
-        box = extent.replace('BOX(', '').replace(')', '')
-        min_part, max_part = box.split(',')
-        minx, miny = [float(x) for x in min_part.split(' ')]
-        maxx, maxy = [float(x) for x in max_part.split(' ')]
-        cx = (minx + maxx) / 2.0
-        cy = (miny + maxy) / 2.0
-        return {"bbox": [minx, miny, maxx, maxy], "center": [cy, cx]}
\ No newline at end of file
+async def line_extent(linha: str = Query(..., description="nome da linha em maiúsculas (ex.: LILAS)")):
+    await ensure_lines()
+    try:
+        return LINE_EXTENTS[linha]
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Linha não encontrada.")
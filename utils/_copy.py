@@ -0,0 +1,36 @@
+"""
+Carga de DataFrames via COPY (psycopg2) para substituir df.to_sql, que envia um
+INSERT por linha.
+"""
+
+import io
+
+import pandas as pd
+from sqlalchemy import text
+
+
+def copy_into(conn, df: pd.DataFrame, table_name: str) -> None:
+    """Carrega df em uma tabela existente via COPY ... FROM STDIN (CSV)."""
+    buf = io.StringIO()
+    df.to_csv(buf, index=False)
+    buf.seek(0)
+    cols = ", ".join(f'"{c}"' for c in df.columns)
+    with conn.connection.cursor() as cur:
+        cur.copy_expert(f"COPY {table_name} ({cols}) FROM STDIN WITH (FORMAT csv, HEADER true)", buf)
+
+
+def copy_df(conn, df: pd.DataFrame, table_name: str) -> None:
+    """Equivalente a df.to_sql(table_name, con=conn, if_exists='replace', index=False) usando COPY."""
+    df.head(0).to_sql(table_name, con=conn, if_exists='replace', index=False)
+    copy_into(conn, df, table_name)
+
+
+def copy_staging(conn, df: pd.DataFrame, table_name: str, columns_ddl: str) -> None:
+    """
+    Recria table_name como UNLOGGED com o schema tipado columns_ddl (ex.: com PRIMARY KEY),
+    carrega df via COPY e atualiza as estatísticas para o planner.
+    """
+    conn.execute(text(f"DROP TABLE IF EXISTS {table_name}"))
+    conn.execute(text(f"CREATE UNLOGGED TABLE {table_name} ({columns_ddl})"))
+    copy_into(conn, df, table_name)
+    conn.execute(text(f"ANALYZE {table_name}"))
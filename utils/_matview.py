@@ -0,0 +1,60 @@
+"""
+Materialized view de estatísticas globais de /stats (sem bbox, parâmetros padrão) sobre
+sp_setores. O ETL é dono da view: cria/recria e atualiza; a API (main.py) só a lê.
+"""
+
+from sqlalchemy import text
+
+from utils._stats import build_stats_sql
+
+GLOBAL_STATS_VIEW = "sp_setores_global_stats"
+GLOBAL_STATS_DEFAULTS = {
+    "sample_limit": 800, "bins": 8, "bin_mode": "width",
+    "renda_metric": "vl_renda", "dist_metric": "distancia_metro_m",
+}
+
+
+def create_global_stats(conn) -> bool:
+    """
+    Recria a view com a definição atual de build_stats_sql (DROP + CREATE), se sp_setores
+    já tiver as métricas padrão; senão apenas reporta e devolve False.
+    """
+    d = GLOBAL_STATS_DEFAULTS
+    cols = {r[0] for r in conn.execute(text(
+        """
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema='public' AND table_name='sp_setores' AND column_name IN (:renda, :dist)
+        """
+    ), {"renda": d["renda_metric"], "dist": d["dist_metric"]})}
+    if len(cols) < 2:
+        print(f"Materialized view '{GLOBAL_STATS_VIEW}' skipped: sp_setores ainda sem {d['renda_metric']}/{d['dist_metric']}.")
+        return False
+    renda_col, dist_col = f'"{d["renda_metric"]}"', f'"{d["dist_metric"]}"'
+    where_sql = f"{renda_col} IS NOT NULL AND {dist_col} IS NOT NULL"
+    # A view não aceita parâmetros: :lim e :bins entram como literais
+    view_sql = build_stats_sql(renda_col, dist_col, where_sql, d["bin_mode"]).bindparams(
+        lim=d["sample_limit"], bins=d["bins"]
+    ).compile(dialect=conn.dialect, compile_kwargs={"literal_binds": True})
+    conn.execute(text(f"DROP MATERIALIZED VIEW IF EXISTS {GLOBAL_STATS_VIEW}"))
+    conn.execute(text(
+        f"CREATE MATERIALIZED VIEW {GLOBAL_STATS_VIEW} AS "
+        f"SELECT 1 AS id, q.stats::json AS stats_json FROM ({view_sql}) q"
+    ))
+    # Índice único: requisito do REFRESH MATERIALIZED VIEW CONCURRENTLY
+    conn.execute(text(f"CREATE UNIQUE INDEX idx_{GLOBAL_STATS_VIEW}_id ON {GLOBAL_STATS_VIEW} (id)"))
+    print(f"Materialized view '{GLOBAL_STATS_VIEW}' created.")
+    return True
+
+
+def refresh_global_stats(conn) -> None:
+    """REFRESH CONCURRENTLY (não bloqueia leituras da API) se a view existir; senão a cria."""
+    if conn.execute(text("SELECT to_regclass(:v)"), {"v": GLOBAL_STATS_VIEW}).scalar() is None:
+        create_global_stats(conn)
+        return
+    conn.execute(text(f"REFRESH MATERIALIZED VIEW CONCURRENTLY {GLOBAL_STATS_VIEW}"))
+    print(f"Materialized view '{GLOBAL_STATS_VIEW}' refreshed.")
+
+
+def drop_global_stats(conn) -> None:
+    """Remove a view antes de substituir sp_setores; create_features.py/load_census.py a recriam."""
+    conn.execute(text(f"DROP MATERIALIZED VIEW IF EXISTS {GLOBAL_STATS_VIEW}"))
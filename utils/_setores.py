@@ -0,0 +1,14 @@
+"""
+Definições de sp_setores compartilhadas entre os scripts de ETL e a API.
+"""
+
+from sqlalchemy import text
+
+# Geometrias simplificadas pré-calculadas (níveis de detalhe): coluna -> tolerância em graus.
+# create_features.py cria as colunas; main.py escolhe a mais próxima do ?simplify= pedido
+SIMPLIFY_LODS = {"geom_s001": 0.001, "geom_s0005": 0.0005, "geom_s0001": 0.0001}
+
+
+def ensure_cd_mun_index(conn, table_name: str) -> None:
+    """Índice em "CD_MUN" para os joins por município (sem cast: o staging usa o mesmo formato)."""
+    conn.execute(text(f'CREATE INDEX IF NOT EXISTS idx_{table_name}_cd_mun ON {table_name} ("CD_MUN")'))
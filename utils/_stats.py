@@ -0,0 +1,178 @@
+"""
+Consulta de estatísticas de /stats sobre sp_setores, compartilhada pela API (main.py) e
+pela materialized view de estatísticas globais mantida pelo ETL (utils/_matview.py).
+"""
+
+from sqlalchemy import text
+
+
+def build_stats_sql(renda_col: str, dist_col: str, where_sql: str, bin_mode: str):
+    """
+    Consulta única de /stats sobre sp_setores filtrado por where_sql; devolve um objeto JSON
+    (coluna stats) com os agregados, a amostra de pares (:lim) e os bins (:bins).
+    """
+    # Bins por distância (s) e intra-município (j, demeaned): largura igual ou quantis.
+    # Quantis: cortes via percentile_cont (um agregado ordenado) e atribuição por width_bucket,
+    # sem ordenar todas as linhas numa janela NTILE; bins numerados a partir de 1
+    if bin_mode == "quantile":
+        bins_cte = """
+        qcuts AS (
+            SELECT ARRAY(SELECT i::float8 / CAST(:bins AS int)
+                         FROM generate_series(1, CAST(:bins AS int) - 1) i) AS fracs
+        ), qedges AS (
+            SELECT (SELECT percentile_cont(fracs) WITHIN GROUP (ORDER BY dist) FROM s)     AS edges,
+                   (SELECT percentile_cont(fracs) WITHIN GROUP (ORDER BY dist_res) FROM j) AS edges_res
+            FROM qcuts
+        ), bins_rows AS (
+            SELECT bin::int,
+                   MIN(dist) AS min_edge,
+                   MAX(dist) AS max_edge,
+                   COUNT(*)  AS n,
+                   AVG(renda) AS renda_avg,
+                   AVG(dist)  AS dist_avg
+            FROM (SELECT renda, dist, width_bucket(dist, qedges.edges) + 1 AS bin FROM s, qedges) r
+            GROUP BY bin
+        ), bins_demean_rows AS (
+            SELECT bin::int,
+                   MIN(dist_res) AS min_edge,
+                   MAX(dist_res) AS max_edge,
+                   COUNT(*)      AS n,
+                   AVG(renda_res) AS renda_avg,
+                   AVG(dist_res)  AS dist_avg
+            FROM (SELECT renda_res, dist_res, width_bucket(dist_res, qedges.edges_res) + 1 AS bin FROM j, qedges) r
+            GROUP BY bin
+        )"""
+    else:
+        bins_cte = """
+        params AS (
+            SELECT CAST(:bins AS int) AS bins
+        ), edges AS (
+            SELECT i AS bin,
+                   ext.min_d + i * (ext.max_d - ext.min_d) / NULLIF(params.bins, 0) AS min_edge,
+                   ext.min_d + (i+1) * (ext.max_d - ext.min_d) / NULLIF(params.bins, 0) AS max_edge,
+                   params.bins
+            FROM generate_series(0, (SELECT bins-1 FROM params)) i,
+                 (SELECT MIN(dist) AS min_d, MAX(dist) AS max_d FROM s) ext, params
+        ), edges_demean AS (
+            SELECT i AS bin,
+                   ext.min_d + i * (ext.max_d - ext.min_d) / NULLIF(params.bins, 0) AS min_edge,
+                   ext.min_d + (i+1) * (ext.max_d - ext.min_d) / NULLIF(params.bins, 0) AS max_edge,
+                   params.bins
+            FROM generate_series(0, (SELECT bins-1 FROM params)) i,
+                 (SELECT MIN(dist_res) AS min_d, MAX(dist_res) AS max_d FROM j) ext, params
+        ), bins_rows AS (
+            SELECT e.bin::int,
+                   e.min_edge,
+                   e.max_edge,
+                   COUNT(s.*)             AS n,
+                   AVG(s.renda)           AS renda_avg,
+                   AVG(s.dist)            AS dist_avg
+            FROM edges e
+            LEFT JOIN s
+              ON s.dist >= e.min_edge AND (s.dist < e.max_edge OR (e.bin = e.bins-1 AND s.dist <= e.max_edge))
+            GROUP BY e.bin, e.min_edge, e.max_edge
+        ), bins_demean_rows AS (
+            SELECT e.bin::int,
+                   e.min_edge,
+                   e.max_edge,
+                   COUNT(j.*)               AS n,
+                   AVG(j.renda_res)         AS renda_avg,
+                   AVG(j.dist_res)          AS dist_avg
+            FROM edges_demean e
+            LEFT JOIN j
+              ON j.dist_res >= e.min_edge AND (j.dist_res < e.max_edge OR (e.bin = e.bins-1 AND j.dist_res <= e.max_edge))
+            GROUP BY e.bin, e.min_edge, e.max_edge
+        )"""
+
+    # Todas as estatísticas numa única consulta: o recorte filtrado (s), as médias por
+    # município (m) e os residuais (j) são materializados uma vez e reutilizados
+    return text(
+        f"""
+        WITH s AS MATERIALIZED (
+            SELECT {renda_col}::float8 AS renda, {dist_col}::float8 AS dist, "CD_MUN"::text AS cd_mun
+            FROM sp_setores
+            WHERE {where_sql}
+        ), m AS MATERIALIZED (
+            SELECT cd_mun, AVG(renda) AS renda_m, AVG(dist) AS dist_m FROM s GROUP BY cd_mun
+        ), j AS MATERIALIZED (
+            SELECT (s.renda - m.renda_m) AS renda_res,
+                   (s.dist  - m.dist_m)  AS dist_res
+            FROM s JOIN m USING (cd_mun)
+        ),
+        -- Agregados estatísticos numa única passada (Pearson derivado das somas no Python)
+        agg AS (
+            SELECT COUNT(*) AS n,
+                   SUM(renda) AS sx, SUM(dist) AS sy, SUM(renda * dist) AS sxy,
+                   SUM(renda * renda) AS sxx, SUM(dist * dist) AS syy,
+                   MIN(renda) AS renda_min, MAX(renda) AS renda_max,
+                   MIN(dist) AS dist_min, MAX(dist) AS dist_max
+            FROM s
+        ),
+        -- Spearman via ranks
+        spear AS (
+            SELECT corr(renda_rnk, dist_rnk) AS r_s
+            FROM (
+                SELECT PERCENT_RANK() OVER (ORDER BY renda) AS renda_rnk,
+                       PERCENT_RANK() OVER (ORDER BY dist)  AS dist_rnk
+                FROM s
+            ) r
+        ),
+        -- Correlação após remover efeito fixo municipal (demeaning por CD_MUN)
+        demean AS (
+            SELECT COUNT(*) AS n, SUM(renda_res) AS sx, SUM(dist_res) AS sy,
+                   SUM(renda_res * dist_res) AS sxy, SUM(renda_res * renda_res) AS sxx,
+                   SUM(dist_res * dist_res) AS syy
+            FROM j
+        ),
+        -- Spearman nos residuais
+        spear_demean AS (
+            SELECT corr(rr, dr) AS r_s_res
+            FROM (
+                SELECT PERCENT_RANK() OVER (ORDER BY renda_res) AS rr,
+                       PERCENT_RANK() OVER (ORDER BY dist_res)  AS dr
+                FROM j
+            ) r
+        ),
+        -- Correlação intermunicipal (between)
+        btw AS (
+            SELECT COUNT(*) AS n, SUM(renda_m) AS sx, SUM(dist_m) AS sy,
+                   SUM(renda_m * dist_m) AS sxy, SUM(renda_m * renda_m) AS sxx,
+                   SUM(dist_m * dist_m) AS syy
+            FROM m
+        ), btw_spear AS (
+            SELECT corr(rr, dr) AS r_s_between
+            FROM (
+                SELECT PERCENT_RANK() OVER (ORDER BY renda_m) AS rr,
+                       PERCENT_RANK() OVER (ORDER BY dist_m)  AS dr
+                FROM m
+            ) r
+        ),
+        -- Amostra de pares: pré-amostra Bernoulli de s (~3x o limite) e ORDER BY random()
+        -- apenas sobre ela, mantendo a amostra uniforme sem ordenar o recorte inteiro
+        pairs AS (
+            SELECT renda, dist
+            FROM (
+                SELECT renda, dist FROM s
+                WHERE random() < LEAST(1.0, CAST(:lim AS float8) * 3 / NULLIF((SELECT n FROM agg), 0))
+            ) x
+            ORDER BY random()
+            LIMIT :lim
+        ),
+        {bins_cte}
+        SELECT json_build_object(
+            'n', agg.n,
+            'sums', json_build_array(agg.n, agg.sx, agg.sy, agg.sxy, agg.sxx, agg.syy),
+            'renda_min', agg.renda_min, 'renda_max', agg.renda_max,
+            'dist_min', agg.dist_min, 'dist_max', agg.dist_max,
+            'r_s', spear.r_s,
+            'sums_res', json_build_array(demean.n, demean.sx, demean.sy, demean.sxy, demean.sxx, demean.syy),
+            'r_s_res', spear_demean.r_s_res,
+            'sums_between', json_build_array(btw.n, btw.sx, btw.sy, btw.sxy, btw.sxx, btw.syy),
+            'r_s_between', btw_spear.r_s_between,
+            'pairs', (SELECT COALESCE(json_agg(json_build_array(renda, dist)), '[]'::json) FROM pairs),
+            'bins_rows', (SELECT COALESCE(json_agg(b ORDER BY b.bin), '[]'::json) FROM bins_rows b),
+            'bins_demean_rows', (SELECT COALESCE(json_agg(b ORDER BY b.bin), '[]'::json) FROM bins_demean_rows b)
+        )::text AS stats
+        FROM agg, spear, demean, spear_demean, btw, btw_spear
+        """
+    )
@@ -0,0 +1,34 @@
+"""
+Cache de pyproj.Transformer compartilhado pelos loaders (load_geography.py, load_pois.py).
+
+Construir um Transformer no PROJ 6+ consulta o banco sqlite do PROJ a cada chamada;
+aqui ele é criado uma vez por par (origem, destino) e reaproveitado.
+"""
+
+from functools import lru_cache
+
+import geopandas as gpd
+import numpy as np
+import pyproj
+import shapely
+
+
+@lru_cache(maxsize=64)
+def TransformerFromCRS(src: str, dst: str, always_xy: bool = True) -> pyproj.Transformer:
+    return pyproj.Transformer.from_crs(src, dst, always_xy=always_xy)
+
+
+def to_crs(gdf: gpd.GeoDataFrame, crs_target: str) -> gpd.GeoDataFrame:
+    """Equivalente a gdf.to_crs(crs_target), usando o Transformer em cache."""
+    has_z = gdf.has_z
+    if has_z.any() and not has_z.all():
+        # 2D e 3D misturados: o geopandas preserva a dimensão de cada geometria
+        return gdf.to_crs(crs_target)
+    include_z = bool(has_z.any())
+    transformer = TransformerFromCRS(gdf.crs.to_string(), crs_target)
+
+    def _project(coords: np.ndarray) -> np.ndarray:
+        return np.column_stack(transformer.transform(*coords.T))
+
+    geoms = shapely.transform(np.asarray(gdf.geometry), _project, include_z=include_z)
+    return gdf.set_geometry(gpd.GeoSeries(geoms, index=gdf.index, crs=crs_target, name=gdf.geometry.name))